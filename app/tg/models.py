@@ -1,4 +1,8 @@
-from tortoise import fields
+import hashlib
+from datetime import datetime
+from typing import List
+
+from tortoise import fields, models, timezone
 
 from cores.constant.tg import DialogType, AccountStatus, DialogSyncType, DialogSyncStatus
 from cores.model import Model
@@ -18,6 +22,7 @@ class Account(Model):
     first_name = fields.CharField(max_length=50, default="", null=False)
     last_name = fields.CharField(max_length=50, default="", null=False)
     tg_id = fields.BigIntField(null=False)
+    dialog_update_state = fields.JSONField(null=True, description="对话信息同步的更新状态 {pts, qts, date, seq, full_synced_at}")
 
     class Meta:
         table = "tg_accounts"
@@ -32,13 +37,54 @@ class Dialog(Model):
     type = fields.IntEnumField(enum_type=DialogType, default=DialogType.USER)
     status = fields.BooleanField(default=True)
     tg_id = fields.BigIntField(null=False)
+    access_hash = fields.BigIntField(null=True, description="TG access_hash，用于本地构造 InputPeer")
+    fingerprint = fields.BigIntField(null=True, description="同步字段的指纹，未变化时跳过写入")
     account = fields.ForeignKeyField("models.Account", related_name="dialogs")
 
     class Meta:
         table = "tg_dialogs"
-        indexes = [
-            ("tg_id", "account_id"),
-        ]
+        unique_together = (("account", "tg_id"),)
+
+    def get_fingerprint(self) -> int:
+        """
+        同步写入字段的 64 位指纹
+        :return:
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(repr((self.title, self.username, int(self.type), self.access_hash)).encode())
+        return int.from_bytes(digest.digest(), "big", signed=True)
+
+    @classmethod
+    async def bulk_upsert(cls, dialogs: List["Dialog"], batch_size: int = 500):
+        """
+        批量写入对话，每批一条 INSERT ... ON DUPLICATE KEY UPDATE，已软删除的对话重新出现时恢复
+        :param dialogs:
+        :param batch_size:
+        :return:
+        """
+        now = timezone.now()
+        for dialog in dialogs:
+            dialog.updated_at = now
+            dialog.deleted_at = None
+            dialog.fingerprint = dialog.get_fingerprint()
+        await cls.bulk_create(
+            dialogs,
+            on_conflict=["account_id", "tg_id"],
+            update_fields=["title", "username", "type", "access_hash", "fingerprint", "updated_at", "deleted_at"],
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    async def soft_delete(cls, account_id: int, tg_ids: List[int]) -> int:
+        """
+        软删除账号下的对话
+        :param account_id:
+        :param tg_ids:
+        :return: 删除的行数
+        """
+        return await cls.get_queryset().filter(account_id=account_id, tg_id__in=tg_ids).update(
+            deleted_at=timezone.now()
+        )
 
 
 class DialogSync(Model):
@@ -51,9 +97,87 @@ class DialogSync(Model):
     type = fields.IntEnumField(enum_type=DialogSyncType, default=DialogSyncType.AUTO)
     status = fields.IntEnumField(enum_type=DialogSyncStatus, default=DialogSyncStatus.ENABLE)
     settings = fields.JSONField(null=True)
+    last_message_id = fields.BigIntField(default=0, description="已成功同步的最后一条源消息ID")
 
     class Meta:
         table = "tg_dialog_syncs"
         indexes = [
             ("account_id", "from_dialog_id", "to_dialog_id"),
         ]
+
+
+class DialogSyncMessage(models.Model):
+    """
+    同步消息映射表
+    记录源消息与目标消息的对应关系，用于编辑、删除、回复和去重
+    数据量可达千万级，不继承通用 Model，只保留紧凑字段，按 created_at 分批清理过期数据
+    """
+    id = fields.BigIntField(pk=True)
+    sync_id = fields.IntField(description="对话同步ID")
+    source_message_id = fields.IntField(description="源消息ID")
+    target_message_id = fields.IntField(description="目标消息ID")
+    grouped_id = fields.BigIntField(null=True, description="相册ID")
+    content_hash = fields.BigIntField(null=True, description="消息内容指纹")
+    media_id = fields.BigIntField(null=True, description="媒体ID，编辑时判断媒体是否变化")
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "tg_dialog_sync_messages"
+        unique_together = (("sync_id", "source_message_id"),)
+        indexes = [
+            ("sync_id", "target_message_id"),
+            ("created_at",),
+        ]
+
+    @classmethod
+    async def prune(cls, before: datetime, batch_size: int = 10000) -> int:
+        """
+        分批删除过期的映射，避免长事务和大范围锁
+        :param before: 删除该时间之前创建的映射
+        :param batch_size: 每批删除的行数
+        :return: 删除的行数
+        """
+        deleted = 0
+        while ids := await cls.filter(created_at__lt=before).limit(batch_size).values_list("id", flat=True):
+            deleted += await cls.filter(id__in=ids).delete()
+        return deleted
+
+
+class TGSession(models.Model):
+    """
+    TG会话表
+    会话存储后端为 db 时使用，保存授权信息和更新状态
+    """
+    id = fields.IntField(pk=True)
+    phone = fields.CharField(max_length=20, unique=True, description="账号手机号")
+    dc_id = fields.IntField(default=0)
+    server_address = fields.CharField(max_length=64, null=True)
+    port = fields.IntField(null=True)
+    auth_key = fields.BinaryField(null=True)
+    takeout_id = fields.BigIntField(null=True)
+    update_states = fields.JSONField(null=True, description="{实体ID: [pts, qts, date, seq]}")
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    class Meta:
+        table = "tg_sessions"
+
+
+class TGSessionEntity(models.Model):
+    """
+    TG会话实体缓存表
+    """
+    id = fields.BigIntField(pk=True)
+    session_phone = fields.CharField(max_length=20, description="账号手机号")
+    tg_id = fields.BigIntField(description="带类型标记的实体ID")
+    hash = fields.BigIntField()
+    username = fields.CharField(max_length=64, null=True)
+    phone = fields.CharField(max_length=20, null=True)
+    name = fields.CharField(max_length=255, null=True)
+
+    class Meta:
+        table = "tg_session_entities"
+        unique_together = (("session_phone", "tg_id"),)
+        indexes = [
+            ("session_phone", "username"),
+            ("session_phone", "phone"),
+        ]
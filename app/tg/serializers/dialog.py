@@ -5,5 +5,5 @@ from app.tg.models import Dialog
 DialogDetail = pydantic_model_creator(
     Dialog,
     name="DialogDetail",
-    exclude=("account",),
+    exclude=("account", "access_hash", "fingerprint"),
 )
@@ -2,7 +2,8 @@ from jose import JWTError
 from passlib.exc import InvalidTokenError
 
 from cores.constant.socket import WsMessage, SioEvent
-from cores.constant.tg import ACCOUNT_LOGIN_CHANNEL, ACCOUNT_LOGIN_CODE, ACCOUNT_DIALOG_SYNC_CHANNEL
+from cores.constant.tg import ACCOUNT_LOGIN_CODE
+from cores.job_queue import ACCOUNT_LOGIN_QUEUE, ACCOUNT_DIALOG_SYNC_QUEUE
 from cores.jwt import verify_token
 from cores.log import LOG
 from cores.redis import ASYNC_REDIS
@@ -53,9 +54,14 @@ async def tg_account_login(sid: str, phone: str):
     # 进入房间
     LOG.info(f"客户端 {sid} 进入房间 {phone}")
     await sio.enter_room(sid=sid, room=phone)
-    # 通知中台 crontabs/account/login.py 启动登录程序
+    # 通知中台 crontabs/account/login.py 启动登录程序，同一账户的登录进行中时只加入房间
     LOG.info(f"通知中台启动登录程序 {phone}")
-    await ASYNC_REDIS.publish(ACCOUNT_LOGIN_CHANNEL, phone)
+    created, state = await ACCOUNT_LOGIN_QUEUE.submit(phone, {"phone": phone})
+    if not created:
+        LOG.info(f"账户 {phone} 登录已在进行中 {state}")
+        await sio.emit(SioEvent.TG_ACCOUNT_LOGIN_UPDATE.value, data=f"{phone}登录已在进行中({state['status']})",
+                       room=sid)
+        return
     # 通知客户端正在启动登录
     LOG.info(f"通知客户端正在启动登录 {phone}")
     await sio.emit(SioEvent.TG_ACCOUNT_LOGIN_UPDATE.value, data=f"{phone}正在启动登录", room=phone)
@@ -66,7 +72,13 @@ async def tg_account_login_code(sid: str, phone: str, code: str):
     LOG.info(f"客户端 {sid} 请求登录账户 {phone} 验证码 {code}")
     # redis 设置验证码
     LOG.info(f"设置验证码 {phone} {code}")
-    await ASYNC_REDIS.set(ACCOUNT_LOGIN_CODE.format(phone=phone), code, ex=300)
+    # 推入列表，登录程序通过 BLPOP 等待，无需轮询
+    name = ACCOUNT_LOGIN_CODE.format(phone=phone)
+    # 旧版本以字符串保存验证码，滚动发布期间残留的字符串会导致 RPUSH 报 WRONGTYPE
+    if await ASYNC_REDIS.type(name) not in ("list", "none"):
+        await ASYNC_REDIS.delete(name)
+    await ASYNC_REDIS.rpush(name, code)
+    await ASYNC_REDIS.expire(name, 300)
     # 通知客户端验证码设置成功
     LOG.info(f"通知客户端验证码设置成功 {phone} {code}")
     await sio.emit(SioEvent.TG_ACCOUNT_LOGIN_UPDATE.value, data=f"{phone}验证码设置成功", room=phone)
@@ -78,9 +90,14 @@ async def tg_account_dialog_info_sync(sid: str, phone: str):
     # 进入房间
     LOG.info(f"客户端 {sid} 进入房间 {phone}")
     await sio.enter_room(sid=sid, room=phone)
-    # 通知中台 crontabs/account/dialog_info_sync.py 启动同步程序
+    # 通知中台 crontabs/account/dialog_info_sync.py 启动同步程序，同步进行中时只加入房间接收进度
     LOG.info(f"通知中台启动同步程序 {phone}")
-    await ASYNC_REDIS.publish(ACCOUNT_DIALOG_SYNC_CHANNEL, phone)
+    created, state = await ACCOUNT_DIALOG_SYNC_QUEUE.submit(phone, {"phone": phone})
+    if not created:
+        LOG.info(f"账户 {phone} 对话信息同步已在进行中 {state}")
+        await sio.emit(SioEvent.TG_ACCOUNT_DIALOG_INFO_SYNC_UPDATE.value,
+                       data=f"{phone}对话信息同步已在进行中({state['status']})", room=sid)
+        return
     # 通知客户端正在同步对话信息
     LOG.info(f"通知客户端正在同步对话信息 {phone}")
     await sio.emit(SioEvent.TG_ACCOUNT_DIALOG_INFO_SYNC_UPDATE.value, data=f"{phone}正在同步对话信息", room=phone)
@@ -65,6 +65,19 @@ class TGConfig:
     session_file: str
     file_save_path: str
     session_path: str
+    client_idle_ttl: int = 600  # 连接池中空闲客户端的存活时间（秒）
+    message_sync_interval: int = 60  # 消息同步的调度间隔（秒）
+    message_map_retention_days: int = 90  # 消息映射的保留天数
+    media_cache_size_mb: int = 10240  # 媒体缓存容量（MB）
+    pipeline_queue_depth: int = 4  # 消息同步流水线每个阶段最多缓冲的页数/批次数
+    message_sync_concurrency: int = 10  # 同时运行的消息同步任务数
+    message_sync_account_concurrency: int = 2  # 单个账号同时运行的消息同步任务数
+    sync_lease_ttl: int = 60  # 多进程同步时账号租约的过期时间（秒）
+    job_concurrency: int = 10  # 登录、对话信息同步进程同时处理的作业数
+    session_backend: str = "file"  # 会话存储：file 本地 session 文件，db 数据库，redis
+    client_manager: bool = False  # 是否通过客户端管理进程访问TG，需要启动 tg_client_manager 服务，开启时消息同步不能运行
+    dialog_full_sync_days: int = 7  # 对话信息距上次全量同步超过该天数时重新全量同步，其余时间增量同步
+    progress_emits_per_second: float = 2  # 同一房间每秒最多发送的进度事件数
 
 
 @dataclass
@@ -135,6 +148,26 @@ def read_config() -> Settings:
     github_config = GitHubConfig(**config["github"])
 
     tg_config = TGConfig(**config["tg"])
+    tg_config.client_idle_ttl = config.getint("tg", "client_idle_ttl", fallback=TGConfig.client_idle_ttl)
+    tg_config.message_sync_interval = config.getint("tg", "message_sync_interval",
+                                                    fallback=TGConfig.message_sync_interval)
+    tg_config.message_map_retention_days = config.getint("tg", "message_map_retention_days",
+                                                         fallback=TGConfig.message_map_retention_days)
+    tg_config.media_cache_size_mb = config.getint("tg", "media_cache_size_mb", fallback=TGConfig.media_cache_size_mb)
+    tg_config.pipeline_queue_depth = config.getint("tg", "pipeline_queue_depth",
+                                                   fallback=TGConfig.pipeline_queue_depth)
+    tg_config.message_sync_concurrency = config.getint("tg", "message_sync_concurrency",
+                                                       fallback=TGConfig.message_sync_concurrency)
+    tg_config.message_sync_account_concurrency = config.getint("tg", "message_sync_account_concurrency",
+                                                               fallback=TGConfig.message_sync_account_concurrency)
+    tg_config.sync_lease_ttl = config.getint("tg", "sync_lease_ttl", fallback=TGConfig.sync_lease_ttl)
+    tg_config.job_concurrency = config.getint("tg", "job_concurrency", fallback=TGConfig.job_concurrency)
+    tg_config.session_backend = config.get("tg", "session_backend", fallback=TGConfig.session_backend)
+    tg_config.client_manager = config.getboolean("tg", "client_manager", fallback=TGConfig.client_manager)
+    tg_config.dialog_full_sync_days = config.getint("tg", "dialog_full_sync_days",
+                                                    fallback=TGConfig.dialog_full_sync_days)
+    tg_config.progress_emits_per_second = config.getfloat("tg", "progress_emits_per_second",
+                                                          fallback=TGConfig.progress_emits_per_second)
     feishu_config = FeishuConfig(**config["feishu"])
     feishu_config.alert = config.getboolean("feishu", "alert")
 
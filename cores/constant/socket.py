@@ -30,3 +30,4 @@ class SioEvent(Enum):
     TG_ACCOUNT_DIALOG_INFO_SYNC_UPDATE = "tg_account_dialog_info_sync_update"  # 账户对话信息同步状态更新
     TG_ACCOUNT_DIALOG_INFO_SYNC_SUCCESS = "tg_account_dialog_info_sync_success"  # 账户对话信息同步成功
     TG_ACCOUNT_DIALOG_INFO_SYNC_ERROR = "tg_account_dialog_info_sync_error"  # 账户对话信息同步失败
+    TG_ACCOUNT_DIALOG_INFO_SYNC_PROGRESS = "tg_account_dialog_info_sync_progress"  # 账户对话信息同步进度
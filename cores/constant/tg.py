@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from enum import IntEnum
+from enum import IntEnum, Enum
 
 
 class AccountStatus(IntEnum):
@@ -23,10 +23,50 @@ class DialogType(IntEnum):
     CHAT_FORBIDDEN = 5
 
 
-ACCOUNT_LOGIN_CHANNEL = "tg:login_task:channel"
-ACCOUNT_LOGIN_CODE = "tg:code:{phone}"
+ACCOUNT_LOGIN_STREAM = "tg:login_task:stream"
+ACCOUNT_LOGIN_CODE = "tg:code:{phone}"  # 验证码列表，前端推入，登录程序 BLPOP 等待
 
-ACCOUNT_DIALOG_SYNC_CHANNEL = "tg:dialog_sync_task:channel"
+ACCOUNT_DIALOG_SYNC_STREAM = "tg:dialog_sync_task:stream"
+JOB_RECLAIM_IDLE = 60  # 作业超过该时间（秒）没有心跳时由其他消费者认领，处理中的作业每 1/3 时间续期一次
+JOB_STATE_KEY = "tg:job_state:{stream}:{key}"  # 同一对象同时只有一个未完成的作业，值为作业状态
+JOB_QUEUED_STATE_TTL = 600  # 排队中的作业没有心跳，状态最多保留的秒数
+
+FORWARD_BATCH_LIMIT = 100  # 单次 forward_messages 最多转发的消息数
+MESSAGE_CHANGE_WINDOW = 2.0  # 源消息编辑、删除的合并窗口（秒）
+
+TG_RATE_LIMIT_KEY = "tg:rate_limit:{account_id}"
+TG_MEDIA_INDEX_KEY = "tg:media:index"  # TG媒体ID -> 内容哈希
+TG_SYNC_LEASE_KEY = "tg:sync:lease:{account_id}"  # 账号同步租约，值为持有的进程ID
+TG_SYNC_WORKERS_KEY = "tg:sync:workers"  # 在线的同步进程 -> 最近心跳时间
+TG_SESSION_KEY = "tg:session:{phone}"  # 会话授权信息和更新状态
+TG_SESSION_ENTITIES_KEY = "tg:session:{phone}:entities"  # 会话实体缓存，实体ID -> 实体行
+TG_RPC_REQUEST_KEY = "tg:rpc:requests"  # 客户端管理进程的请求队列
+TG_RPC_REPLY_KEY = "tg:rpc:reply:{request_id}"  # 单个请求的回复
+
+
+class TGRequestType(Enum):
+    """
+    TG请求类型，每个账号的每种请求类型单独限速
+    """
+    AUTH = "auth"  # 登录
+    SEND = "send"  # 发送、转发消息
+    GET_HISTORY = "get_history"  # 获取历史消息
+    GET_ENTITY = "get_entity"  # 获取实体
+    GET_DIALOGS = "get_dialogs"  # 获取对话列表
+    DOWNLOAD = "download"  # 下载媒体
+
+
+# 每种请求类型的最大速率（次/秒），遇到 FloodWait 后会自动降低
+TG_REQUEST_RATES = {
+    TGRequestType.AUTH: 0.2,
+    TGRequestType.SEND: 1.0,
+    TGRequestType.GET_HISTORY: 3.0,
+    TGRequestType.GET_ENTITY: 2.0,
+    TGRequestType.GET_DIALOGS: 1.0,
+    TGRequestType.DOWNLOAD: 2.0,
+}
+# 重试有副作用的请求类型，FloodWait 时只降速不重试，如重试登录会再次发送验证码
+TG_NO_RETRY_REQUEST_TYPES = {TGRequestType.AUTH}
 
 
 class DialogSyncType(IntEnum):
@@ -50,5 +90,8 @@ class DialogSyncSetting:
     """
     对话同步设置
     """
-    message_reversed: bool = False  # 消息是否倒序
-    only_latest_message: bool = False  # 只同步最新消息
+    message_reversed: bool = False  # 消息是否倒序（已废弃，增量同步固定按消息ID正序进行）
+    only_latest_message: bool = False  # 只同步最新消息：实时监听新消息，不回填历史
+    batch_size: int = FORWARD_BATCH_LIMIT  # 每批转发的消息数，最大 100
+    batch_max_wait: float = 1.0  # 批次最长等待时间（秒），超时未满也会发送
+    drop_author: bool = True  # 转发时隐藏来源，等同于复制消息
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+from cores.constant.tg import ACCOUNT_LOGIN_STREAM, ACCOUNT_DIALOG_SYNC_STREAM, JOB_RECLAIM_IDLE, JOB_STATE_KEY, \
+    JOB_QUEUED_STATE_TTL
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+
+# 仅当状态仍属于该作业时删除，避免删掉之后提交的新作业的状态
+CLEAR_STATE_SCRIPT = """
+local state = redis.call('get', KEYS[1])
+if state and cjson.decode(state)['job_id'] == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+@dataclass
+class Job:
+    """
+    队列中的作业
+    """
+    id: str
+    data: dict
+    deliveries: int = 1  # 已投递次数，包含本次
+
+
+class RedisJobQueue:
+    """
+    基于 redis stream 的作业队列
+    1. 生产者 XADD，消费者通过消费组读取，多个消费者之间不会重复消费
+    2. 处理完成后 ack，处理期间定时续期，消费者退出或宕机后作业超时被其他消费者认领
+    3. 处理失败的作业立即重新入队，投递次数超过上限的转入死信 stream，保留数据和错误信息供排查
+    4. 通过 submit 提交的作业按 key 单飞，同一 key 未完成时不重复提交，返回进行中作业的状态
+       处理中的状态随心跳续期，消费者宕机后在 reclaim_idle 内失效
+    """
+
+    def __init__(self, stream: str, group: str, max_deliveries: int = 3, reclaim_idle: int = JOB_RECLAIM_IDLE,
+                 max_length: int = 10000, queued_state_ttl: int = JOB_QUEUED_STATE_TTL):
+        self.stream = stream
+        self.group = group
+        self.dead_stream = f"{stream}:dead"
+        self.max_deliveries = max_deliveries
+        self.reclaim_idle_ms = int(reclaim_idle * 1000)
+        self.max_length = max_length
+        self.queued_state_ttl_ms = int(queued_state_ttl * 1000)
+        self.group_created = False
+
+    @classmethod
+    def get_consumer_name(cls) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    async def put(self, data: dict, deliveries: int = 0) -> str:
+        """
+        提交作业
+        :param data:
+        :param deliveries: 重新入队时之前已投递的次数
+        :return: 作业ID
+        """
+        job_id = await ASYNC_REDIS.xadd(
+            self.stream, {"data": json.dumps(data), "deliveries": deliveries}, maxlen=self.max_length,
+            approximate=True,
+        )
+        LOG.info(f"Job queued. Stream: {self.stream}, Job: {job_id}, Data: {data}")
+        return job_id
+
+    def get_state_key(self, key: str) -> str:
+        return JOB_STATE_KEY.format(stream=self.stream, key=key)
+
+    async def submit(self, key: str, data: dict) -> Tuple[bool, dict]:
+        """
+        单飞提交，同一 key 已有未完成的作业时不再提交
+        :param key: 单飞的对象，如手机号
+        :param data:
+        :return: (是否新提交, 作业状态)
+        """
+        name = self.get_state_key(key)
+        state = {"status": "queued", "job_id": None, "updated_at": int(time.time())}
+        if not await ASYNC_REDIS.set(name, json.dumps(state), nx=True, px=self.queued_state_ttl_ms):
+            current = await ASYNC_REDIS.get(name)
+            # 状态恰好过期时按已完成处理，重新提交
+            if current is None:
+                return await self.submit(key, data)
+            LOG.info(f"Job in flight, skip. Stream: {self.stream}, Key: {key}, State: {current}")
+            return False, json.loads(current)
+        try:
+            state["job_id"] = await self.put({**data, "key": key})
+        except Exception:
+            await ASYNC_REDIS.delete(name)
+            raise
+        await ASYNC_REDIS.set(name, json.dumps(state), xx=True, keepttl=True)
+        return True, state
+
+    async def set_state(self, job: Job, status: str):
+        """
+        更新作业状态，处理中的状态由 keep_alive 续期，排队中的状态保留 queued_state_ttl
+        :param job:
+        :param status: running 或 retrying
+        :return:
+        """
+        if key := job.data.get("key"):
+            state = {"status": status, "job_id": job.id, "updated_at": int(time.time())}
+            ttl = self.reclaim_idle_ms if status == "running" else self.queued_state_ttl_ms
+            await ASYNC_REDIS.set(self.get_state_key(key), json.dumps(state), px=ttl)
+
+    async def clear_state(self, job: Job):
+        if key := job.data.get("key"):
+            await ASYNC_REDIS.eval(CLEAR_STATE_SCRIPT, 1, self.get_state_key(key), job.id)
+
+    async def ensure_group(self):
+        if self.group_created:
+            return
+        try:
+            # 从头读取，消费组创建前提交的作业也会被处理
+            await ASYNC_REDIS.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.group_created = True
+
+    async def reclaim(self, consumer: str, count: int) -> List[Job]:
+        """
+        认领超时未 ack 的作业，超过投递上限的转入死信
+        :param consumer:
+        :param count:
+        :return:
+        """
+        pending = await ASYNC_REDIS.xpending_range(
+            self.stream, self.group, min="-", max="+", count=count, idle=self.reclaim_idle_ms
+        )
+        jobs = []
+        for entry in pending:
+            job_id = entry["message_id"]
+            entries = await ASYNC_REDIS.xrange(self.stream, min=job_id, max=job_id)
+            # 已被裁剪的作业没有数据，直接确认
+            if not entries:
+                await ASYNC_REDIS.xack(self.stream, self.group, job_id)
+                continue
+            fields = entries[0][1]
+            # 重新入队前的投递次数 + 本条目的投递次数
+            deliveries = int(fields.get("deliveries", 0)) + entry["times_delivered"]
+            if deliveries >= self.max_deliveries:
+                job = Job(id=job_id, data=json.loads(fields["data"]), deliveries=deliveries)
+                await self.dead(job, f"Not acked after {deliveries} deliveries")
+                continue
+            for claimed_id, claimed_fields in await ASYNC_REDIS.xclaim(
+                    self.stream, self.group, consumer, self.reclaim_idle_ms, [job_id]
+            ):
+                if not claimed_fields:
+                    await ASYNC_REDIS.xack(self.stream, self.group, claimed_id)
+                    continue
+                LOG.warning(f"Job reclaimed. Stream: {self.stream}, Job: {claimed_id}, Consumer: {consumer}")
+                jobs.append(Job(id=claimed_id, data=json.loads(claimed_fields["data"]), deliveries=deliveries + 1))
+        return jobs
+
+    async def read(self, consumer: str, count: int = 1, block: int = 5000) -> List[Job]:
+        """
+        读取作业，优先认领超时的作业
+        :param consumer: 消费者名称
+        :param count: 最多读取的作业数
+        :param block: 没有新作业时阻塞等待的毫秒数
+        :return:
+        """
+        await self.ensure_group()
+        if jobs := await self.reclaim(consumer, count):
+            return jobs
+        response = await ASYNC_REDIS.xreadgroup(self.group, consumer, {self.stream: ">"}, count=count, block=block)
+        return [
+            Job(id=job_id, data=json.loads(fields["data"]), deliveries=int(fields.get("deliveries", 0)) + 1)
+            for _, entries in response or []
+            for job_id, fields in entries
+        ]
+
+    async def touch(self, job: Job, consumer: str):
+        """
+        续期处理中的作业，重置空闲时间，不增加投递次数
+        :param job:
+        :param consumer:
+        :return:
+        """
+        await ASYNC_REDIS.xclaim(self.stream, self.group, consumer, 0, [job.id], justid=True)
+        if key := job.data.get("key"):
+            await ASYNC_REDIS.pexpire(self.get_state_key(key), self.reclaim_idle_ms)
+
+    async def keep_alive(self, job: Job, consumer: str):
+        """处理期间定时续期，避免耗时较长的作业被其他消费者认领后重复执行"""
+        while True:
+            await asyncio.sleep(self.reclaim_idle_ms / 1000 / 3)
+            try:
+                await self.touch(job, consumer)
+            except Exception as e:
+                LOG.warning(f"Job keep alive failed. Stream: {self.stream}, Job: {job.id}, Error: {e}")
+
+    async def ack(self, job: Job):
+        await ASYNC_REDIS.xack(self.stream, self.group, job.id)
+        await self.clear_state(job)
+
+    async def dead(self, job: Job, error: str):
+        """
+        转入死信并确认，不再重试
+        :param job:
+        :param error:
+        :return:
+        """
+        LOG.error(f"Job dead. Stream: {self.stream}, Job: {job.id}, Data: {job.data}, Error: {error}")
+        await ASYNC_REDIS.xadd(
+            self.dead_stream,
+            {"job_id": job.id, "data": json.dumps(job.data), "error": error, "deliveries": job.deliveries},
+            maxlen=self.max_length, approximate=True,
+        )
+        await self.ack(job)
+
+    async def fail(self, job: Job, error: Optional[str] = None):
+        """
+        处理失败，未达投递上限时立即重新入队，否则转入死信
+        :param job:
+        :param error:
+        :return:
+        """
+        if job.deliveries >= self.max_deliveries:
+            await self.dead(job, error or "")
+            return
+        # 新条目带上已投递次数，确认旧条目，不必等待 reclaim_idle 后被认领
+        retry = Job(id=await self.put(job.data, deliveries=job.deliveries), data=job.data)
+        await ASYNC_REDIS.xack(self.stream, self.group, job.id)
+        await self.set_state(retry, "retrying")
+        LOG.warning(f"Job failed, requeued. Stream: {self.stream}, Job: {job.id} -> {retry.id}, "
+                    f"Deliveries: {job.deliveries}, Error: {error}")
+
+
+# 登录需要用户输入验证码，失败后不自动重试
+ACCOUNT_LOGIN_QUEUE = RedisJobQueue(ACCOUNT_LOGIN_STREAM, "login", max_deliveries=1)
+ACCOUNT_DIALOG_SYNC_QUEUE = RedisJobQueue(ACCOUNT_DIALOG_SYNC_STREAM, "dialog_sync", max_deliveries=3)
@@ -1,23 +1,38 @@
 import asyncio
+import time
+from dataclasses import dataclass
+from typing import List, Set, Optional
 
-from telethon.tl.types import Chat, ChatForbidden, User, Channel
+from telethon.tl.types import Chat, ChatForbidden, User, Channel, ChatEmpty, UserEmpty
 
 from app.tg.models import Account, Dialog
-from cores.constant.tg import DialogType, ACCOUNT_DIALOG_SYNC_CHANNEL
+from cores.config import settings
+from cores.constant.tg import DialogType
+from cores.job_queue import ACCOUNT_DIALOG_SYNC_QUEUE, Job
 from cores.log import LOG
-from cores.redis import REDIS
-from crontabs.base import TGClientMethod, BaseDBScript, SIOClientMethod
+from crontabs.base import TGClientMethod, BaseDBScript, SIOClientMethod, TG_CLIENT_POOL, JobConsumerMethod, \
+    DialogDifference, SIOProgressReporter
+from crontabs.rpc import TG_RPC_CLIENT
 
 
-class AccountDialogInfoSync(BaseDBScript, TGClientMethod, SIOClientMethod):
+@dataclass
+class DialogChangeSummary:
+    """
+    对话信息同步的变更统计
+    """
+    inserted: int = 0
+    changed: int = 0
+    removed: int = 0
+    unchanged: int = 0
+
+
+class AccountDialogInfoSync(BaseDBScript, TGClientMethod, SIOClientMethod, JobConsumerMethod):
     """
     同步账号对话信息
     """
 
     def __init__(self):
-        self.async_redis = REDIS
-        self.task_channel_name = ACCOUNT_DIALOG_SYNC_CHANNEL
-        self.pub = self.async_redis.pubsub()
+        self.queue = ACCOUNT_DIALOG_SYNC_QUEUE
 
     @classmethod
     def get_dialog_type(cls, dialog):
@@ -32,86 +47,219 @@ class AccountDialogInfoSync(BaseDBScript, TGClientMethod, SIOClientMethod):
         else:
             return DialogType.GROUP
 
+    @classmethod
+    def build_dialog(cls, account: Account, tg_id: int, dialog_entity) -> Dialog:
+        """
+        将TG对话实体转换为待写入的对话记录
+        :param account:
+        :param tg_id: 带类型标记的对话ID
+        :param dialog_entity:
+        :return:
+        """
+        LOG.debug(f"Dialog: {dialog_entity.to_dict()}")
+        # 获取对话类型
+        dialog_type = cls.get_dialog_type(dialog_entity)
+        # 获取对话标题和用户名，ChannelForbidden 等受限实体缺少部分字段
+        if dialog_type in (DialogType.CHAT, DialogType.CHAT_FORBIDDEN):
+            dialog_title, dialog_username = getattr(dialog_entity, "title", None), None
+        elif dialog_type == DialogType.USER:
+            dialog_title = getattr(dialog_entity, "first_name", None)
+            dialog_username = getattr(dialog_entity, "username", None)
+        else:
+            dialog_title = getattr(dialog_entity, "title", None)
+            dialog_username = getattr(dialog_entity, "username", None)
+        return Dialog(
+            tg_id=tg_id,
+            account_id=account.id,
+            title=dialog_title,
+            username=dialog_username,
+            type=dialog_type,
+            access_hash=getattr(dialog_entity, "access_hash", None),
+        )
+
+    @classmethod
+    async def save_dialogs(cls, account: Account, rows: List[Dialog], progress: SIOProgressReporter,
+                           full: bool = True, peer_ids: Set[int] = frozenset(),
+                           batch_size: int = 500) -> DialogChangeSummary:
+        """
+        与已保存的指纹比较，只写入新增、变化和消失的对话，分批写入并上报进度
+        :param account:
+        :param rows:
+        :param progress: 进度上报，保存阶段按写入的行数计数
+        :param full: 是否为全量对话，全量时软删除未出现的对话
+        :param peer_ids: 增量同步时确定属于对话的ID，其余实体只更新已保存的对话
+        :param batch_size:
+        :return:
+        """
+        queryset = Dialog.filter(account_id=account.id)
+        if not full:
+            queryset = queryset.filter(tg_id__in=[row.tg_id for row in rows])
+        saved = {
+            tg_id: (fingerprint, deleted_at)
+            for tg_id, fingerprint, deleted_at in await queryset.values_list("tg_id", "fingerprint", "deleted_at")
+        }
+        summary = DialogChangeSummary()
+        changed_rows = []
+        for row in rows:
+            if not full and row.tg_id not in saved and row.tg_id not in peer_ids:
+                # 更新中附带的实体（如群成员）不是对话
+                continue
+            if row.tg_id not in saved:
+                summary.inserted += 1
+            elif saved[row.tg_id] != (row.get_fingerprint(), None):
+                # 字段变化，或已删除的对话重新出现
+                summary.changed += 1
+            else:
+                summary.unchanged += 1
+                continue
+            changed_rows.append(row)
+        progress.start_stage("save", total=len(changed_rows))
+        for start in range(0, len(changed_rows), batch_size):
+            batch = changed_rows[start:start + batch_size]
+            await Dialog.bulk_upsert(batch, batch_size=batch_size)
+            progress.update(advance=len(batch))
+
+        if not full:
+            return summary
+        # 获取结果为空时多半是异常，不做删除
+        current = {row.tg_id for row in rows}
+        removed = [tg_id for tg_id, (_, deleted_at) in saved.items() if deleted_at is None and tg_id not in current]
+        if rows and removed:
+            summary.removed = await Dialog.soft_delete(account.id, removed)
+        return summary
+
+    async def get_dialogs(self, account: Account, progress: SIOProgressReporter):
+        """
+        获取账号的全部对话，启用客户端管理进程时通过 RPC 获取，否则从连接池获取客户端
+        :param account:
+        :param progress: 进度上报，获取阶段按已获取的对话数计数
+        :return:
+        """
+        progress.start_stage("fetch")
+        if settings.tg.client_manager:
+            dialogs = await TG_RPC_CLIENT.get_dialogs(account)
+            progress.update(advance=len(dialogs))
+            return dialogs
+        # 从连接池获取客户端，重复同步同一账号时复用连接
+        dialogs = []
+        async with self.use_client(account) as client:
+            async for dialog in self.iter_dialogs(client, account):
+                dialogs.append(dialog)
+                progress.update()
+        return dialogs
+
+    async def fetch_update_state(self, account: Account) -> dict:
+        if settings.tg.client_manager:
+            return await TG_RPC_CLIENT.get_update_state(account)
+        async with self.use_client(account) as client:
+            return await self.get_update_state(client, account)
+
+    async def fetch_dialog_difference(self, account: Account) -> Optional[DialogDifference]:
+        """
+        获取上次同步以来变化的对话，没有保存状态、距上次全量同步过久或状态过旧时返回 None
+        :param account:
+        :return:
+        """
+        state = account.dialog_update_state
+        max_age = settings.tg.dialog_full_sync_days * 24 * 60 * 60
+        if not state or time.time() - state.get("full_synced_at", 0) > max_age:
+            return None
+        if settings.tg.client_manager:
+            difference = await TG_RPC_CLIENT.get_dialog_difference(account, state)
+        else:
+            async with self.use_client(account) as client:
+                difference = await self.get_dialog_difference(client, account, state)
+        if difference is not None:
+            difference.state["full_synced_at"] = state["full_synced_at"]
+        return difference
+
     async def update_channel_info(self, account: Account):
-        # 获取客户端
-        client = self.get_client(account)
         LOG.info(f"Start client. Account: {account.phone}")
         await self.send_sync_dialog_info_update_message(account.phone, f"{account.phone}启动客户端...")
-        # 启动客户端
-        await self.start_client(client=client, account=account)
         await self.send_sync_dialog_info_update_message(account.phone, f"{account.phone}获取对话信息...")
-        # 获取频道信息
-        async for dialog in client.iter_dialogs():
-            # 转换为实体
-            dialog_entity = await client.get_entity(dialog.id)
-            LOG.info(f"Dialog: {dialog_entity.to_dict()}")
-            await self.send_sync_dialog_info_update_message(account.phone,
-                                                            f"{account.phone}正在同步对话: {dialog_entity.username}...")
-
-            # 获取对话类型
-            dialog_type = self.get_dialog_type(dialog_entity)
-            # 获取对话标题和用户名
-            if dialog_type in (DialogType.CHAT, DialogType.CHAT_FORBIDDEN):
-                dialog_title, dialog_username = dialog_entity.title
-            elif dialog_type == DialogType.USER:
-                dialog_title = dialog_entity.first_name
-                dialog_username = dialog_entity.username
-            else:
-                dialog_title = dialog_entity.title
-                dialog_username = dialog_entity.username
-
-            # 判断是否存在
-            dialog_info, created = await Dialog.update_or_create(
-                tg_id=dialog.id,
-                account_id=account.id,
-                defaults={
-                    "title": dialog_title,
-                    "username": dialog_username,
-                    "type": dialog_type,
-                }
-            )
-            if created:
-                LOG.info(f"Dialog created. Dialog: {dialog_info.username}, Created: {created}")
-            else:
-                LOG.info(f"Dialog updated. Dialog: {dialog_info.username}, Created: {created}")
+        # 获取阶段按对话数上报，保存阶段按写入行数上报
+        async with self.sync_dialog_info_progress(account.phone) as progress:
+            state, rows, summary, full = await self.sync_dialogs(account, progress)
+        account.dialog_update_state = state
+        await account.save(update_fields=["dialog_update_state"])
+        LOG.info(f"Dialogs saved. Account: {account.phone}, Full: {full}, Count: {len(rows)}, "
+                 f"Summary: {summary}")
+        await self.send_sync_dialog_info_update_message(
+            account.phone, f"{account.phone}新增{summary.inserted}个，更新{summary.changed}个，"
+                           f"删除{summary.removed}个，未变化{summary.unchanged}个对话"
+        )
 
         # 发送同步完成消息
         await self.send_sync_dialog_info_update_message(account.phone, f"{account.phone}对话信息同步完成...")
-        # 关闭客户端
-        client.disconnect()
-        await self.send_sync_dialog_info_update_message(account.phone, f"{account.phone}关闭客户端...")
+
+    async def sync_dialogs(self, account: Account, progress: SIOProgressReporter):
+        """
+        增量或全量同步对话
+        :param account:
+        :param progress:
+        :return: (新的更新状态, 对话记录, 变更统计, 是否全量)
+        """
+        if difference := await self.fetch_dialog_difference(account):
+            # 增量同步：只处理上次同步以来有变化的对话，更新中附带的其他实体（如群成员）不是对话
+            saved_ids = set(await Dialog.filter(
+                account_id=account.id, tg_id__in=list(difference.entities)
+            ).values_list("tg_id", flat=True))
+            rows = [
+                self.build_dialog(account, tg_id, entity)
+                for tg_id, entity in difference.entities.items()
+                if tg_id in difference.peer_ids or tg_id in saved_ids
+                # 空实体不含任何信息，不覆盖已保存的对话
+                if not isinstance(entity, (ChatEmpty, UserEmpty))
+            ]
+            summary = await self.save_dialogs(account, rows, progress, full=False, peer_ids=difference.peer_ids)
+            state = difference.state
+        else:
+            # 全量同步：先记录状态再枚举，枚举期间的变化留给下次增量同步
+            state = {**await self.fetch_update_state(account), "full_synced_at": int(time.time())}
+            dialogs = await self.get_dialogs(account, progress)
+            await self.send_sync_dialog_info_update_message(
+                account.phone, f"{account.phone}正在保存{len(dialogs)}个对话..."
+            )
+            # iter_dialogs 已经返回了实体，无需再调用 get_entity
+            rows = [self.build_dialog(account, dialog.id, dialog.entity) for dialog in dialogs]
+            summary = await self.save_dialogs(account, rows, progress)
+        return state, rows, summary, difference is None
+
+    async def handle_job(self, job: Job):
+        """
+        处理对话同步作业，成功后 ack，失败时立即重新入队，超过投递次数后转入死信
+        :param job:
+        :return:
+        """
+        phone = job.data["phone"]
+        LOG.info(f"Receive phone. Phone: {phone}, Job: {job.id}")
+        await self.send_sync_dialog_info_update_message(phone, f"{phone}正在同步对话信息...")
+        try:
+            if account := await Account.get_or_none(phone=phone):
+                LOG.info(f"Account found. Phone: {phone}")
+                # 同步对话信息
+                await self.update_channel_info(account)
+                # 发送同步成功消息
+                await self.send_sync_dialog_info_success(phone)
+                await self.queue.ack(job)
+            else:
+                LOG.error(f"Account not found. Phone: {phone}")
+                await self.send_sync_dialog_info_error(phone)
+                await self.queue.dead(job, "Account not found")
+        except Exception as e:
+            LOG.error(f"Error: {e}")
+            await self.send_sync_dialog_info_error(phone)
+            raise e
 
     async def __call__(self, *args, **kwargs):
         """
         任务逻辑
+        从作业队列接收同步请求
         :param args:
         :param kwargs:
         :return:
         """
-        # 订阅任务通道
-        LOG.info(f"Subscribe task channel. Channel: {self.task_channel_name}")
-        self.pub.subscribe(self.task_channel_name)
-        # 监听任务
-        for message in self.pub.listen():
-            LOG.info(f"Receive message. Message: {message}")
-            if message["type"] == "message":
-                phone = message["data"]
-                LOG.info(f"Receive phone. Phone: {phone}")
-                await self.send_sync_dialog_info_update_message(phone, f"{phone}正在同步对话信息...")
-                try:
-                    if account := await Account.get_or_none(phone=phone):
-                        LOG.info(f"Account found. Phone: {phone}")
-                        # 同步对话信息
-                        await self.update_channel_info(account)
-                        # 发送同步成功消息
-                        await self.send_sync_dialog_info_success(phone)
-                    else:
-                        LOG.error(f"Account not found. Phone: {phone}")
-                        raise
-                except Exception as e:
-                    LOG.error(f"Error: {e}")
-                    await self.send_sync_dialog_info_error(phone)
-                    raise e
+        await self.consume(self.queue)
 
 
 async def main():
@@ -120,10 +268,12 @@ async def main():
     # 初始化数据库
     await server.init_db()
 
-    await server()
-
-    # 关闭数据库
-    await server.close_db()
+    try:
+        await server()
+    finally:
+        await TG_CLIENT_POOL.close_all()
+        # 关闭数据库
+        await server.close_db()
 
 
 if __name__ == '__main__':
@@ -1,16 +1,17 @@
 import asyncio
 import functools
-import time
-from datetime import datetime, timedelta
 
 from app.tg.models import Account
-from cores.constant.tg import ACCOUNT_LOGIN_CHANNEL, ACCOUNT_LOGIN_CODE, AccountStatus
+from cores.config import settings
+from cores.constant.tg import ACCOUNT_LOGIN_CODE, AccountStatus, TGRequestType
+from cores.job_queue import ACCOUNT_LOGIN_QUEUE, Job
 from cores.log import LOG
-from cores.redis import REDIS
-from crontabs.base import BaseDBScript, TGClientMethod, SIOClientMethod
+from cores.redis import ASYNC_REDIS
+from crontabs.base import BaseDBScript, TGClientMethod, SIOClientMethod, JobConsumerMethod
+from crontabs.rpc import TG_RPC_CLIENT
 
 
-class AccountLogin(BaseDBScript, TGClientMethod, SIOClientMethod):
+class AccountLogin(BaseDBScript, TGClientMethod, SIOClientMethod, JobConsumerMethod):
     """
     登录账号，初始化客户端
     对于第一次登录的账号，需要打开TG客户端，获取验证码，输入验证码，登录账号
@@ -18,29 +19,30 @@ class AccountLogin(BaseDBScript, TGClientMethod, SIOClientMethod):
     """
 
     def __init__(self):
-        self.redis = REDIS
-        self.async_redis = REDIS
-        self.task_channel_name = ACCOUNT_LOGIN_CHANNEL
-        self.pub = self.async_redis.pubsub()
+        self.redis = ASYNC_REDIS
+        self.queue = ACCOUNT_LOGIN_QUEUE
         self.code_name_prefix = ACCOUNT_LOGIN_CODE
 
-    def get_code_from_redis(self, phone, timeout=60):
+    async def get_code_from_redis(self, phone, timeout=60):
+        """
+        阻塞等待前端推送的验证码，不占用事件循环
+        :param phone:
+        :param timeout: 等待的秒数
+        :return: 超时返回 None
+        """
         LOG.info(f"Get code from redis. Phone: {phone}")
-        end = datetime.now() + timedelta(seconds=timeout)
         name = self.code_name_prefix.format(phone=phone)
-        while datetime.now() < end:
-            if code := self.redis.get(name):
-                self.redis.delete(name)
-                LOG.info(f"Get code from redis. Phone: {phone}, Code: {code}")
-                return code
-            LOG.info(f"Code not found in redis. Name: {name}")
-            time.sleep(1)
+        if result := await self.redis.blpop([name], timeout=timeout):
+            code = result[1]
+            LOG.info(f"Get code from redis. Phone: {phone}, Code: {code}")
+            return code
+        LOG.info(f"Code not found in redis. Name: {name}")
         return None
 
     async def save_account_info(self, account, client):
         await self.send_login_update_message(account.phone, f"{account.phone}登录成功，正在获取账号信息...")
         # 获取账号信息
-        me = await client.get_me()
+        me = await self.call(account, TGRequestType.GET_ENTITY, client.get_me)
         LOG.info(me.to_dict())
         await self.send_login_update_message(account.phone, f"{account.phone}账号信息获取成功，正在保存账号信息...")
         # 保存账号信息
@@ -55,8 +57,10 @@ class AccountLogin(BaseDBScript, TGClientMethod, SIOClientMethod):
 
     async def init_client(self, account: Account):
         # 获取客户端
-        client = self.get_client(account)
+        client = await self.get_client(account)
         LOG.info(f"Start client. Account: {account.phone}")
+        # 清除上次登录残留的验证码，验证码在请求发送之后才会推送
+        await self.redis.delete(self.code_name_prefix.format(phone=account.phone))
         # 验证码，从redis中获取验证码
         code_callback = functools.partial(self.get_code_from_redis, account.phone)
         # 启动客户端
@@ -64,44 +68,53 @@ class AccountLogin(BaseDBScript, TGClientMethod, SIOClientMethod):
         # 保存账号信息
         await self.save_account_info(account, client)
         # 关闭客户端
-        client.disconnect()
+        await self.close_client(client)
         await self.send_login_update_message(account.phone, f"{account.phone}登录成功，关闭客户端...")
+        # 通知客户端管理进程接管连接，登录已成功，失败时管理进程会在下次刷新账号时连接
+        if settings.tg.client_manager:
+            try:
+                await TG_RPC_CLIENT.connect(account)
+            except Exception as e:
+                LOG.warning(f"Notify client manager failed. Account: {account.phone}, Error: {e}")
+
+    async def handle_job(self, job: Job):
+        """
+        处理登录作业，成功后 ack，失败时通知前端并转入死信
+        :param job:
+        :return:
+        """
+        phone = job.data["phone"]
+        LOG.info(f"Receive phone. Phone: {phone}, Job: {job.id}")
+        # 发送消息给前端
+        await self.send_login_update_message(phone, f"{phone}正在启动登录...")
+        try:
+            # 获取账号
+            if account := await Account.get_or_none(phone=phone):
+                LOG.info(f"Account found. Phone: {phone}")
+                await self.send_login_update_message(phone, f"{phone}正在初始化客户端...")
+                # 初始化客户端
+                await self.init_client(account)
+                # 发送登录成功消息
+                await self.send_login_success(phone)
+                await self.queue.ack(job)
+            else:
+                LOG.error(f"Account not found. Phone: {phone}")
+                await self.send_login_error(phone)
+                await self.queue.dead(job, "Account not found")
+        except Exception as e:
+            LOG.error(f"Error: {e}")
+            await self.send_login_error(phone)
+            raise e
 
     async def __call__(self, *args, **kwargs):
         """
         任务逻辑
-        接收登录请求，初始化客户端
+        从作业队列接收登录请求，初始化客户端
         :param args:
         :param kwargs:
         :return:
         """
-        # 订阅任务通道
-        LOG.info(f"Subscribe task channel. Channel: {self.task_channel_name}")
-        self.pub.subscribe(self.task_channel_name)
-        # 监听任务
-        for message in self.pub.listen():
-            LOG.info(f"Receive message. Message: {message}")
-            if message["type"] == "message":
-                phone = message["data"]
-                LOG.info(f"Receive phone. Phone: {phone}")
-                # 发送消息给前端
-                await self.send_login_update_message(phone, f"{phone}正在启动登录...")
-                try:
-                    # 获取账号
-                    if account := await Account.get_or_none(phone=phone):
-                        LOG.info(f"Account found. Phone: {phone}")
-                        await self.send_login_update_message(phone, f"{phone}正在初始化客户端...")
-                        # 初始化客户端
-                        await self.init_client(account)
-                        # 发送登录成功消息
-                        await self.send_login_success(phone)
-                    else:
-                        LOG.error(f"Account not found. Phone: {phone}")
-                        raise
-                except Exception as e:
-                    LOG.error(f"Error: {e}")
-                    await self.send_login_error(phone)
-                    raise e
+        await self.consume(self.queue)
 
 
 async def main():
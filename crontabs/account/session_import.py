@@ -0,0 +1,66 @@
+import asyncio
+import glob
+import os
+
+from cores.config import settings
+from cores.log import LOG
+from crontabs.base import BaseDBScript
+from crontabs.session import SESSION_STORES, StoredSession
+
+
+class SessionImport(BaseDBScript):
+    """
+    将本地 session 文件导入 session_backend 配置的存储，切换存储前执行一次，账号无需重新登录
+    存储中已有的会话不会被覆盖
+    """
+
+    def __init__(self, session_path: str = settings.tg.session_path):
+        self.session_path = session_path
+
+    async def import_session(self, store, path: str) -> bool:
+        """
+        导入单个 session 文件
+        :param store:
+        :param path:
+        :return: 是否导入
+        """
+        phone = os.path.splitext(os.path.basename(path))[0]
+        if (await store.load(phone))[0] is not None:
+            LOG.info(f"Session exists, skip. Phone: {phone}")
+            return False
+        state, entities = await asyncio.to_thread(StoredSession.read_session_file, path)
+        if state is None:
+            LOG.warning(f"Session not authorized, skip. Phone: {phone}")
+            return False
+        await store.save(phone, state, entities)
+        LOG.info(f"Session imported. Phone: {phone}, Entities: {len(entities)}")
+        return True
+
+    async def __call__(self, *args, **kwargs):
+        store = SESSION_STORES.get(settings.tg.session_backend)
+        if store is None:
+            LOG.error(f"Session backend is not db or redis. Backend: {settings.tg.session_backend}")
+            return
+        imported = 0
+        for path in sorted(glob.glob(os.path.join(self.session_path, "*.session"))):
+            try:
+                imported += await self.import_session(store, path)
+            except Exception as e:
+                LOG.exception(f"Import session failed. Path: {path}, Error: {e}")
+        LOG.info(f"Sessions imported. Backend: {settings.tg.session_backend}, Count: {imported}")
+
+
+async def main():
+    script = SessionImport()
+
+    # 初始化数据库
+    await script.init_db()
+
+    await script()
+
+    # 关闭数据库
+    await script.close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
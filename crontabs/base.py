@@ -1,31 +1,43 @@
 import asyncio
+import contextlib
 import os
+import time
 import traceback
+from abc import ABC, ABCMeta, abstractmethod
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
 from inspect import isawaitable
+from typing import Dict, AsyncIterator, Set, Optional, Tuple
 
-import schedule
 import socketio
-from schedule import Job
-from telethon import TelegramClient, errors
+from telethon import TelegramClient, errors, functions, types, utils
+from telethon.tl import custom
+from telethon.tl.tlobject import TLObject
 from tortoise import Tortoise
 
-from app.tg.models import Account
-from cores import config
+from app.tg.models import Account, Dialog
 from cores.config import settings
 from cores.constant.socket import SioEvent
+from cores.constant.tg import TGRequestType
+from cores.job_queue import RedisJobQueue, Job
 from cores.log import LOG
 from cores.messager import MESSAGE_FACTORY
 from cores.model import TORTOISE_ORM
+from crontabs.entity_cache import TG_ENTITY_CACHE
+from crontabs.rate_limiter import TG_RATE_LIMITER
+from crontabs.scheduler import ScheduleJob, SCRIPT_SCHEDULER, every
+from crontabs.session import StoredSession, SESSION_STORES
 
 redis_manager = socketio.AsyncRedisManager(settings.redis.db_url)
 sio = socketio.AsyncServer(client_manager=redis_manager)
 
 
-class ScriptMeta(type):
+class ScriptMeta(ABCMeta):
     """
-    脚本元类
+    脚本元类，继承 ABCMeta 以便脚本混入抽象基类
     1. 用于捕获脚本执行过程中的异常
-    2. 用于执行定时任务
+    2. 用于执行定时任务，schedule_job 为 crontabs.scheduler.ScheduleJob，首次调用时注册到 SCRIPT_SCHEDULER
 
     """
 
@@ -33,20 +45,20 @@ class ScriptMeta(type):
         # 获取 __call__ 方法
         original_call = dct.get("__call__")
 
+        def register_schedule_job(self, args, kwargs, run):
+            # 获取 schedule_job
+            if schedule_job := kwargs.pop("schedule_job", None) or getattr(self, "schedule_job", None):
+                # 防止 schedule_job 被重复调用
+                setattr(self, "schedule_job", None)
+                assert isinstance(schedule_job, ScheduleJob), "schedule_job 必须是 ScheduleJob 类型"
+                # 类属性上的配置被所有实例共享，每个实例注册一份副本
+                SCRIPT_SCHEDULER.add_job(run, replace(schedule_job, name=schedule_job.name or name, running=set()))
+
         if asyncio.iscoroutinefunction(original_call):  # 判断是否是异步函数
             async def new_call(self, *args, **kwargs):
                 try:
-                    # 获取 schedule_job
-                    if schedule_job := kwargs.pop("schedule_job", None) or getattr(self, "schedule_job", None):
-                        # 防止 schedule_job 被重复调用
-                        setattr(self, "schedule_job", None)
-                        assert isinstance(schedule_job, Job), "schedule_job 必须是 schedule.Job 类型"
-
-                        # 添加定时任务，支持异步
-                        async def wrapped_job():
-                            await self(*args, **kwargs)
-
-                        schedule_job.do(lambda: asyncio.create_task(wrapped_job()))
+                    # 添加定时任务，由调度器跟踪运行实例
+                    register_schedule_job(self, args, kwargs, lambda: self(*args, **kwargs))
 
                     # 调用原始的 __call__ 方法
                     return await original_call(self, *args, **kwargs)
@@ -57,14 +69,8 @@ class ScriptMeta(type):
         else:
             def new_call(self, *args, **kwargs):
                 try:
-                    # 获取 schedule_job
-                    if schedule_job := kwargs.pop("schedule_job", None) or getattr(self, "schedule_job", None):
-                        # 防止 schedule_job 被重复调用
-                        setattr(self, "schedule_job", None)
-                        assert isinstance(schedule_job, Job), "schedule_job 必须是 schedule.Job 类型"
-
-                        # 添加定时任务
-                        schedule_job.do(self, *args, **kwargs)
+                    # 添加定时任务，同步任务在线程中执行，不阻塞事件循环
+                    register_schedule_job(self, args, kwargs, lambda: asyncio.to_thread(self, *args, **kwargs))
 
                     # 调用原始的 __call__ 方法
                     return original_call(self, *args, **kwargs)
@@ -184,22 +190,300 @@ class BaseDBScript(BaseScript):
         await Tortoise.close_connections()
 
 
+class AccountNotAuthorizedError(Exception):
+    """账号未登录，需要先通过登录脚本完成授权"""
+
+
+class TGClientPool:
+    """
+    TG客户端连接池
+    每个账号只保持一个已连接、已授权的客户端，在同一进程的所有任务和调度之间复用
+    断线后在下次使用时重连，空闲超过 idle_ttl 的客户端会被关闭
+    """
+
+    def __init__(self, idle_ttl: int = settings.tg.client_idle_ttl):
+        self.idle_ttl = idle_ttl
+        self.clients: Dict[int, TelegramClient] = {}
+        self.last_used: Dict[int, float] = {}
+        self.in_use: Dict[int, int] = defaultdict(int)
+        self.locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.reaper = None
+
+    async def get(self, account: Account, hold: bool = False) -> TelegramClient:
+        """
+        获取账号的客户端，必要时创建并连接
+        :param account:
+        :param hold: 是否占用，在锁内计数，回收时不会关闭刚取出的客户端
+        :return:
+        """
+        async with self.locks[account.id]:
+            client = self.clients.get(account.id)
+            if client is None:
+                client = await TGClientMethod.get_client(account)
+                self.clients[account.id] = client
+            if not client.is_connected():
+                LOG.info(f"Connect pooled client. Account: {account.phone}")
+                await client.connect()
+                if not await client.is_user_authorized():
+                    await client.disconnect()
+                    self.clients.pop(account.id, None)
+                    raise AccountNotAuthorizedError(f"Account not authorized. Account: {account.phone}")
+            self.last_used[account.id] = time.monotonic()
+            if hold:
+                self.in_use[account.id] += 1
+            self.start_reaper()
+            return client
+
+    async def hold(self, account: Account) -> TelegramClient:
+        """
+        长期占用客户端，占用期间不会被空闲回收，需要配合 release 使用
+        :param account:
+        :return:
+        """
+        return await self.get(account, hold=True)
+
+    def release(self, account_id: int):
+        self.in_use[account_id] -= 1
+        self.last_used[account_id] = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def client(self, account: Account) -> AsyncIterator[TelegramClient]:
+        """
+        使用客户端，使用期间不会被空闲回收
+        :param account:
+        :return:
+        """
+        client = await self.hold(account)
+        try:
+            yield client
+        finally:
+            self.release(account.id)
+
+    def start_reaper(self):
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self.reap_idle())
+
+    async def reap_idle(self):
+        """定期关闭空闲的客户端"""
+        while self.clients:
+            await asyncio.sleep(min(self.idle_ttl, 60))
+            await self.close_idle()
+
+    def is_idle(self, account_id: int) -> bool:
+        now = time.monotonic()
+        return not self.in_use[account_id] and now - self.last_used.get(account_id, now) >= self.idle_ttl
+
+    async def close_idle(self):
+        for account_id in list(self.clients):
+            if self.is_idle(account_id):
+                await self.close(account_id, only_idle=True)
+
+    async def close(self, account_id: int, only_idle: bool = False):
+        """
+        关闭客户端
+        :param account_id:
+        :param only_idle: 只关闭空闲的客户端，在锁内重新检查，等待锁期间被取出的客户端不会关闭
+        :return:
+        """
+        async with self.locks[account_id]:
+            if only_idle:
+                if not self.is_idle(account_id):
+                    return
+                LOG.info(f"Close idle client. Account id: {account_id}")
+            if client := self.clients.pop(account_id, None):
+                await TGClientMethod.close_client(client)
+            self.last_used.pop(account_id, None)
+
+    async def close_all(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+        for account_id in list(self.clients):
+            await self.close(account_id)
+
+
+TG_CLIENT_POOL = TGClientPool()
+
+
+@dataclass
+class DialogDifference:
+    """
+    上次同步以来变化的对话
+    entities: 更新中出现的全部实体，实体ID -> 实体，可能包含非对话的用户（如群成员）
+    peer_ids: 确定有新消息或更新的对话ID
+    state: 新的更新状态
+    """
+    entities: Dict[int, TLObject]
+    peer_ids: Set[int]
+    state: dict
+
+
 class TGClientMethod:
     @classmethod
-    def get_client(cls, account: Account) -> TelegramClient:
+    def use_client(cls, account: Account):
+        """
+        从连接池中获取账号的客户端
+        :param account:
+        :return:
+        """
+        return TG_CLIENT_POOL.client(account)
+
+    @classmethod
+    async def call(cls, account: Account, request_type: TGRequestType, func, *args, **kwargs):
+        """
+        经过限速器调用客户端方法，按账号和请求类型限速，并处理 FloodWait
+        :param account:
+        :param request_type:
+        :param func: 客户端方法，如 client.get_entity
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        return await TG_RATE_LIMITER.call(account.id, request_type, func, *args, **kwargs)
+
+    @classmethod
+    def get_dialog_offset(cls, dialog: custom.Dialog) -> dict:
+        """从该对话之后继续获取对话列表的参数"""
+        return {
+            "offset_date": dialog.date,
+            "offset_id": dialog.message.id if dialog.message else 0,
+            "offset_peer": dialog.input_entity,
+        }
+
+    @classmethod
+    async def iter_dialogs(cls, client: TelegramClient, account: Account) -> AsyncIterator[custom.Dialog]:
+        """
+        分页获取全部对话，每页一次限速请求，FloodWait 后从上一页末尾继续
+        :param client:
+        :param account:
+        :return:
+        """
+        async for dialog in TG_RATE_LIMITER.iterate(account.id, TGRequestType.GET_DIALOGS, client.iter_dialogs,
+                                                    resume=cls.get_dialog_offset, key=lambda item: item.id):
+            yield dialog
+
+    @classmethod
+    async def get_input_peer(cls, client: TelegramClient, account: Account, dialog: Dialog):
+        """
+        获取对话的 InputPeer，优先使用本地缓存的 access_hash
+        :param client:
+        :param account:
+        :param dialog:
+        :return:
+        """
+        return await TG_ENTITY_CACHE.get_input_peer(client, account, dialog)
+
+    @classmethod
+    async def invalidate_input_peer(cls, account: Account, dialog: Dialog):
+        await TG_ENTITY_CACHE.invalidate(account.id, dialog)
+
+    @classmethod
+    async def get_session(cls, account: Account):
+        """
+        获取会话，session_backend 为 db 或 redis 时从存储中一次性加载，否则使用本地 session 文件
+        :param account:
+        :return:
+        """
+        if store := SESSION_STORES.get(settings.tg.session_backend):
+            session = StoredSession(account.phone, store)
+            await session.load()
+            return session
+        return os.path.join(settings.tg.session_path, f"{account.phone}.session")
+
+    @classmethod
+    async def get_client(cls, account: Account) -> TelegramClient:
         """
         获取客户端
         :param account:
         :return:
         """
-        session = os.path.join(settings.tg.session_path, f"{account.phone}.session")
+        session = await cls.get_session(account)
         return TelegramClient(
             session=session,
             api_id=account.api_id,
             api_hash=account.api_hash,
-            timeout=3
+            timeout=3,
+            # FloodWait 交给限速器处理，不在客户端内部静默等待
+            flood_sleep_threshold=0,
         )
 
+    @classmethod
+    def dump_update_state(cls, state: types.updates.State) -> dict:
+        return {"pts": state.pts, "qts": state.qts, "date": int(state.date.timestamp()), "seq": state.seq}
+
+    @classmethod
+    async def get_update_state(cls, client: TelegramClient, account: Account) -> dict:
+        """
+        获取账号当前的更新状态
+        :param client:
+        :param account:
+        :return:
+        """
+        state = await cls.call(account, TGRequestType.GET_DIALOGS, client, functions.updates.GetStateRequest())
+        return cls.dump_update_state(state)
+
+    @classmethod
+    def get_update_peer_ids(cls, difference) -> Set[int]:
+        """从新消息和其他更新中提取对话ID"""
+        peer_ids = set()
+        for message in [*difference.new_messages, *(getattr(u, "message", None) for u in difference.other_updates)]:
+            if isinstance(peer := getattr(message, "peer_id", None), TLObject):
+                peer_ids.add(utils.get_peer_id(peer))
+        for update in difference.other_updates:
+            if isinstance(peer := getattr(update, "peer", None), (types.PeerUser, types.PeerChat, types.PeerChannel)):
+                peer_ids.add(utils.get_peer_id(peer))
+            elif channel_id := getattr(update, "channel_id", None):
+                peer_ids.add(utils.get_peer_id(types.PeerChannel(channel_id)))
+            elif chat_id := getattr(update, "chat_id", None):
+                peer_ids.add(utils.get_peer_id(types.PeerChat(chat_id)))
+        return peer_ids
+
+    @classmethod
+    async def get_dialog_difference(cls, client: TelegramClient, account: Account,
+                                    state: dict) -> Optional[DialogDifference]:
+        """
+        通过 updates.getDifference 获取上次同步以来变化的对话
+        :param client:
+        :param account:
+        :param state: 上次保存的更新状态
+        :return: 状态过旧、需要全量同步时返回 None
+        """
+        difference = DialogDifference(entities={}, peer_ids=set(), state=state)
+        while True:
+            request = functions.updates.GetDifferenceRequest(
+                pts=difference.state["pts"], qts=difference.state["qts"],
+                date=datetime.fromtimestamp(difference.state["date"], tz=timezone.utc),
+            )
+            try:
+                result = await cls.call(account, TGRequestType.GET_DIALOGS, client, request)
+            except (errors.PersistentTimestampInvalidError, errors.PersistentTimestampEmptyError):
+                return None
+            if isinstance(result, types.updates.DifferenceTooLong):
+                return None
+            if isinstance(result, types.updates.DifferenceEmpty):
+                difference.state = {**difference.state, "date": int(result.date.timestamp()), "seq": result.seq}
+                return difference
+
+            for entity in [*result.chats, *result.users]:
+                difference.entities[utils.get_peer_id(entity)] = entity
+            difference.peer_ids |= cls.get_update_peer_ids(result)
+            if isinstance(result, types.updates.DifferenceSlice):
+                # 变化较多时分片返回，从中间状态继续获取
+                difference.state = cls.dump_update_state(result.intermediate_state)
+                continue
+            difference.state = cls.dump_update_state(result.state)
+            return difference
+
+    @classmethod
+    async def close_client(cls, client: TelegramClient):
+        """
+        断开客户端，并立即写入尚未保存的会话
+        :param client:
+        :return:
+        """
+        await client.disconnect()
+        if isinstance(client.session, StoredSession):
+            await client.session.flush()
+
     @classmethod
     async def start_client(cls, client: TelegramClient, account: Account, code_callback=None):
         """
@@ -211,18 +495,159 @@ class TGClientMethod:
         """
         if account.password:
             LOG.info(f"Start client with password. Account: {account.phone}")
-            conn = client.start(phone=account.phone, password=account.password, code_callback=code_callback)
+            await cls.call(account, TGRequestType.AUTH, client.start, phone=account.phone, password=account.password,
+                           code_callback=code_callback)
         else:
-            LOG.info(f"Start client with code. Account: {account.phone}", code_callback=code_callback)
-            conn = client.start(phone=account.phone, code_callback=code_callback)
-
-        if isawaitable(conn):
-            await conn
+            LOG.info(f"Start client with code. Account: {account.phone}")
+            await cls.call(account, TGRequestType.AUTH, client.start, phone=account.phone,
+                           code_callback=code_callback)
 
         LOG.info(f"Client started successfully. Account: {account.phone}")
 
 
+class SIOProgressCoalescer:
+    """
+    同一 (事件, 房间) 的进度合并发送，房间内的所有进度上报共用一个
+    1. 待发送的数据只保留最新一份，每秒最多发送 max_rate 次
+    2. 最终状态立即发送，并丢弃同一上报尚未发送的数据
+    """
+
+    def __init__(self, event: SioEvent, room: str, max_rate: float = settings.tg.progress_emits_per_second):
+        self.event = event
+        self.room = room
+        self.interval = 1 / max(max_rate, 0.1)
+        self.emitted_at = 0.0
+        # (上报, 数据)
+        self.pending: Optional[Tuple[object, dict]] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        # 使用中的上报数量，为 0 时从 SIOClientMethod 中移除
+        self.reporters = 0
+
+    async def emit(self, data: dict):
+        self.emitted_at = time.monotonic()
+        await sio.emit(self.event.value, data=data, room=self.room)
+
+    async def flush_later(self):
+        # 等待期间可能立即发送过最终状态，重新计算间隔
+        while (delay := self.emitted_at + self.interval - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        if self.pending is not None:
+            _, data = self.pending
+            self.pending = None
+            await self.emit(data)
+
+    def push(self, reporter, data: dict):
+        """
+        提交进度，距上次发送不足间隔时合并到下一次发送
+        :param reporter:
+        :param data:
+        :return:
+        """
+        self.pending = (reporter, data)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def send_now(self, reporter, data: dict):
+        """
+        立即发送最终状态
+        :param reporter:
+        :param data:
+        :return:
+        """
+        if self.pending is not None and self.pending[0] is reporter:
+            self.pending = None
+        if self.pending is None and self.flush_task is not None:
+            self.flush_task.cancel()
+        await self.emit(data)
+
+
+class SIOProgressReporter:
+    """
+    进度上报
+    1. 进度更新交给房间的 SIOProgressCoalescer 合并发送，同一房间的多个上报共用限流
+    2. 发送结构化数据 {status, stage, done, total, rate, eta}，rate 为每秒处理数，eta 为预计剩余秒数
+    3. 任务分为多个阶段（如获取、保存）时，每个阶段单独计数
+    4. 结束时总会发送最终状态
+    """
+
+    def __init__(self, coalescer: SIOProgressCoalescer, total: Optional[int] = None, stage: Optional[str] = None):
+        self.coalescer = coalescer
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.started_at = time.monotonic()
+
+    def payload(self, status: str) -> dict:
+        elapsed = time.monotonic() - self.started_at
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = round(max(self.total - self.done, 0) / rate, 1)
+        return {"status": status, "stage": self.stage, "done": self.done, "total": self.total,
+                "rate": round(rate, 2), "eta": eta}
+
+    def update(self, advance: int = 1, total: Optional[int] = None):
+        """
+        更新进度，由 coalescer 限流发送
+        :param advance: 新完成的数量
+        :param total: 总数，未知时为 None
+        :return:
+        """
+        self.done += advance
+        if total is not None:
+            self.total = total
+        self.coalescer.push(self, self.payload("running"))
+
+    def start_stage(self, stage: str, total: Optional[int] = None):
+        """
+        进入新阶段，重新计数
+        :param stage:
+        :param total: 本阶段的总数，未知时为 None
+        :return:
+        """
+        self.stage = stage
+        self.done = 0
+        self.total = total
+        self.started_at = time.monotonic()
+        self.update(advance=0)
+
+    async def close(self, status: str = "success"):
+        """丢弃待发送的更新，发送最终状态"""
+        await self.coalescer.send_now(self, self.payload(status))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close("error" if exc_type else "success")
+
+
 class SIOClientMethod:
+    # (事件, 房间) -> 进度合并发送，上报全部结束后移除
+    progress_coalescers: Dict[Tuple[str, str], SIOProgressCoalescer] = {}
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def progress(cls, event: SioEvent, room: str, total: Optional[int] = None,
+                       stage: Optional[str] = None) -> AsyncIterator[SIOProgressReporter]:
+        """
+        创建进度上报，同一房间的上报共用一个 SIOProgressCoalescer
+        :param event:
+        :param room:
+        :param total:
+        :param stage:
+        :return:
+        """
+        key = (event.value, room)
+        coalescer = cls.progress_coalescers.setdefault(key, SIOProgressCoalescer(event, room))
+        coalescer.reporters += 1
+        try:
+            async with SIOProgressReporter(coalescer, total=total, stage=stage) as reporter:
+                yield reporter
+        finally:
+            coalescer.reporters -= 1
+            if not coalescer.reporters:
+                cls.progress_coalescers.pop(key, None)
     @classmethod
     async def send_login_update_message(cls, phone: str, message: str):
         await sio.emit(SioEvent.TG_ACCOUNT_LOGIN_UPDATE.value, data=message, room=phone)
@@ -247,9 +672,61 @@ class SIOClientMethod:
     async def send_sync_dialog_info_error(cls, phone: str):
         await sio.emit(SioEvent.TG_ACCOUNT_DIALOG_INFO_SYNC_ERROR.value, room=phone)
 
+    @classmethod
+    def sync_dialog_info_progress(cls, phone: str, total: Optional[int] = None, stage: Optional[str] = None):
+        return cls.progress(SioEvent.TG_ACCOUNT_DIALOG_INFO_SYNC_PROGRESS, phone, total=total, stage=stage)
+
+
+class JobConsumerMethod(ABC):
+    """
+    作业队列消费，需要子类实现 handle_job
+    1. 同时处理多个作业，数量不超过 concurrency
+    2. 单个作业失败只记录并告警，不影响其他作业和消费循环
+    3. 处理中的作业定时续期，只有消费者退出或宕机后才会被其他消费者认领
+    """
+
+    @abstractmethod
+    async def handle_job(self, job: Job):
+        """处理单个作业，成功后 ack，抛出异常时由 run_job 按失败处理"""
+
+    async def run_job(self, queue: RedisJobQueue, job: Job, consumer: str):
+        # 处理期间续期，耗时超过认领时间的作业不会被其他消费者重复执行
+        keep_alive = asyncio.create_task(queue.keep_alive(job, consumer))
+        try:
+            await queue.set_state(job, "running")
+            await self.handle_job(job)
+        except Exception as e:
+            self.handle_exception(e, self.__class__.__name__)
+            await queue.fail(job, str(e))
+        finally:
+            keep_alive.cancel()
+
+    async def consume(self, queue: RedisJobQueue, concurrency: int = settings.tg.job_concurrency):
+        """
+        消费作业队列
+        :param queue:
+        :param concurrency: 同时处理的作业数
+        :return:
+        """
+        consumer = queue.get_consumer_name()
+        LOG.info(f"Consume task queue. Stream: {queue.stream}, Consumer: {consumer}, Concurrency: {concurrency}")
+        running: Set[asyncio.Task] = set()
+        try:
+            while True:
+                if len(running) >= concurrency:
+                    _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                # 有作业在处理时缩短阻塞时间，及时补充空出的名额
+                jobs = await queue.read(consumer, count=concurrency - len(running), block=1000 if running else 5000)
+                running = {task for task in running if not task.done()}
+                running.update(asyncio.create_task(self.run_job(queue, job, consumer)) for job in jobs)
+        finally:
+            for task in running:
+                task.cancel()
+
 
 class DemoAsyncScript(BaseScript):
-    schedule_job = schedule.every(1).seconds
+    schedule_job = every(1)
 
     async def async_init(self):
         """初始化任务"""
@@ -268,18 +745,14 @@ async def main():
 
     await script.async_init()
 
-    # 异步定时任务执行
-    async def run_tasks():
-        await script()
-        while True:
-            schedule.run_pending()
-            await asyncio.sleep(1)  # 确保事件循环不会阻塞
-
+    # 首次执行时注册定时任务，之后由调度器按时执行
     try:
-        await run_tasks()
+        await script()
+        await SCRIPT_SCHEDULER.run()
     except KeyboardInterrupt:
         LOG.info("Shutting down...")
     finally:
+        await SCRIPT_SCHEDULER.shutdown()
         LOG.info("Clean up and exit")
 
 
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+from typing import Dict, Set
+
+from telethon import TelegramClient
+
+from app.tg.models import Account
+from cores.config import settings
+from cores.constant.tg import AccountStatus, TG_RPC_REQUEST_KEY, TG_RPC_REPLY_KEY
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+from crontabs.base import BaseDBScript, TGClientMethod, TG_CLIENT_POOL, AccountNotAuthorizedError
+from crontabs.rpc import encode_tl
+from crontabs.scheduler import SCRIPT_SCHEDULER, every
+
+
+class TGClientManager(BaseDBScript, TGClientMethod):
+    """
+    TG客户端管理进程
+    1. 所有正常状态的账号保持连接，连接只在本进程建立一次
+    2. 通过 redis 请求/回复为其他进程提供获取对话和更新状态等操作
+    3. 仅在配置开启 client_manager 时连接账号，未开启时由各进程自行连接
+    """
+    schedule_job = every(60)
+
+    def __init__(self, concurrency: int = 20, reply_expire: int = 60):
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.reply_expire = reply_expire
+        self.accounts: Dict[int, Account] = {}
+        # 本进程长期占用的账号
+        self.held: Set[int] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def hold_account(self, account: Account) -> bool:
+        """
+        保持账号连接，返回是否已授权
+        :param account:
+        :return:
+        """
+        self.accounts[account.id] = account
+        if account.id in self.held:
+            # 连接池会在断线后重连
+            await TG_CLIENT_POOL.get(account)
+            return True
+        try:
+            await TG_CLIENT_POOL.hold(account)
+        except AccountNotAuthorizedError:
+            LOG.warning(f"Account not authorized, skip. Account: {account.phone}")
+            return False
+        self.held.add(account.id)
+        LOG.info(f"Account connected. Account: {account.phone}")
+        return True
+
+    async def refresh_accounts(self):
+        """连接新增的正常账号，释放不再正常的账号"""
+        # 未开启时其他进程各自连接账号，这里不再重复连接
+        if not settings.tg.client_manager:
+            LOG.warning("Client manager disabled, skip refresh accounts")
+            return
+        accounts = {account.id: account for account in await Account.filter(status=AccountStatus.NORMAL)}
+        for account_id in self.held - set(accounts):
+            LOG.info(f"Release account. Account id: {account_id}")
+            self.held.discard(account_id)
+            self.accounts.pop(account_id, None)
+            TG_CLIENT_POOL.release(account_id)
+        for account in accounts.values():
+            try:
+                await self.hold_account(account)
+            except Exception as e:
+                LOG.exception(f"Connect account failed. Account: {account.phone}, Error: {e}")
+
+    async def get_account(self, account_id: int) -> Account:
+        if account := self.accounts.get(account_id):
+            return account
+        return await Account.get(id=account_id)
+
+    async def rpc_connect(self, account: Account, client: TelegramClient):
+        return await self.hold_account(account)
+
+    async def rpc_get_dialogs(self, account: Account, client: TelegramClient):
+        return [
+            {"id": dialog.id, "entity": encode_tl(dialog.entity)} async for dialog in self.iter_dialogs(client, account)
+        ]
+
+    async def rpc_get_update_state(self, account: Account, client: TelegramClient):
+        return await self.get_update_state(client, account)
+
+    async def rpc_get_dialog_difference(self, account: Account, client: TelegramClient, state: dict):
+        if (difference := await self.get_dialog_difference(client, account, state)) is None:
+            return None
+        return {
+            "entities": {tg_id: encode_tl(entity) for tg_id, entity in difference.entities.items()},
+            "peer_ids": list(difference.peer_ids),
+            "state": difference.state,
+        }
+
+    async def handle_request(self, request: dict):
+        """
+        处理单个请求，结果或错误写入回复列表
+        :param request:
+        :return:
+        """
+        reply_key = TG_RPC_REPLY_KEY.format(request_id=request["id"])
+        try:
+            func = getattr(self, f"rpc_{request['method']}", None)
+            if func is None:
+                raise ValueError(f"Unknown method: {request['method']}")
+            account = await self.get_account(request["account_id"])
+            async with self.concurrency, self.use_client(account) as client:
+                reply = {"result": await func(account, client, **request["params"])}
+        except Exception as e:
+            LOG.exception(f"RPC failed. Request: {request}, Error: {e}")
+            reply = {"error": f"{e.__class__.__name__}: {e}"}
+        await ASYNC_REDIS.rpush(reply_key, json.dumps(reply))
+        await ASYNC_REDIS.expire(reply_key, self.reply_expire)
+
+    async def serve(self):
+        LOG.info(f"Serve RPC requests. Key: {TG_RPC_REQUEST_KEY}")
+        while True:
+            if result := await ASYNC_REDIS.blpop([TG_RPC_REQUEST_KEY], timeout=5):
+                request = json.loads(result[1])
+                # 调用方已超时放弃的请求不再执行
+                if request.get("expires_at", float("inf")) < time.time():
+                    LOG.warning(f"RPC request expired, skip. Request: {request}")
+                    continue
+                task = asyncio.create_task(self.handle_request(request))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def __call__(self, *args, **kwargs):
+        await self.refresh_accounts()
+
+
+async def main():
+    manager = TGClientManager()
+
+    await manager.init_db()
+
+    try:
+        # 首次执行时注册定时任务，之后定时刷新账号
+        await manager()
+        await asyncio.gather(manager.serve(), SCRIPT_SCHEDULER.run())
+    finally:
+        await SCRIPT_SCHEDULER.shutdown()
+        await TG_CLIENT_POOL.close_all()
+        await manager.close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
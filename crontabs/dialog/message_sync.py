@@ -1,60 +1,893 @@
 import asyncio
-from typing import List
+import contextlib
+import hashlib
+import time
+from collections import defaultdict, Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Set, AsyncIterator, Dict, Tuple, Callable, Optional, Awaitable
 
-from telethon.tl.types import MessageService
+from telethon import TelegramClient, errors, events, utils
+from telethon.tl.types import Message, MessageService, PeerChannel
+from tortoise.transactions import in_transaction
 
-from app.tg.models import DialogSync
-from cores.constant.tg import DialogSyncSetting
+from app.tg.models import DialogSync, DialogSyncMessage
+from cores.config import settings as config_settings
+from cores.constant.tg import DialogSyncSetting, FORWARD_BATCH_LIMIT, TGRequestType, MESSAGE_CHANGE_WINDOW, \
+    DialogSyncType
 from cores.log import LOG
-from crontabs.base import TGClientMethod, BaseDBScript, SIOClientMethod
+from crontabs.base import TGClientMethod, BaseDBScript, SIOClientMethod, TG_CLIENT_POOL
+from crontabs.entity_cache import INVALID_PEER_ERRORS
+from crontabs.lease import TG_ACCOUNT_LEASES
+from crontabs.media_cache import TG_MEDIA_CACHE
+from crontabs.rate_limiter import TG_RATE_LIMITER
+from crontabs.scheduler import SCRIPT_SCHEDULER, every
+
+
+class MessageBatcher:
+    """
+    消息批次收集器
+    连续的非系统消息按顺序收集成批次，达到批次大小或超过最长等待时间后发送
+    同一相册（grouped_id 相同）的消息不会被拆到两个批次中，末尾的相册即使超时也要等到完整或没有后续消息时才发送
+    """
+
+    def __init__(self, batch_size: int = FORWARD_BATCH_LIMIT, max_wait: float = 1.0):
+        self.batch_size = min(max(batch_size, 1), FORWARD_BATCH_LIMIT)
+        self.max_wait = max_wait
+        self.messages: List[Message] = []
+        self.started_at = 0.0
+
+    def add(self, message: Message) -> bool:
+        """
+        添加消息
+        :param message:
+        :return: 批次是否可以发送
+        """
+        if not self.messages:
+            self.started_at = time.monotonic()
+        self.messages.append(message)
+        return self.is_ready()
+
+    def is_ready(self) -> bool:
+        if not self.messages:
+            return False
+        return len(self.messages) >= self.batch_size or time.monotonic() - self.started_at >= self.max_wait
+
+    def pop(self, complete: bool = False) -> List[Message]:
+        """
+        取出当前批次
+        :param complete: 是否已经没有后续消息，为 False 时末尾的相册可能还不完整，留到下一批
+        :return: 只有一个未完成的相册时返回空列表，等后续消息到达后整组发送
+        """
+        split = len(self.messages)
+        if not complete and (grouped_id := self.messages and self.messages[-1].grouped_id):
+            while split > 0 and self.messages[split - 1].grouped_id == grouped_id:
+                split -= 1
+        messages, self.messages = self.messages[:split], self.messages[split:]
+        self.started_at = time.monotonic()
+        return messages
+
+
+class MessageChangeBuffer:
+    """
+    源消息编辑、删除的合并缓冲
+    窗口内同一条消息的多次编辑只保留最后一次，删除按源对话合并后分批处理
+    key 为 (账号ID, 源对话ID)，非频道的删除事件不带对话ID，此时为 (账号ID, None)
+    """
+
+    def __init__(self, flush: Callable[..., Awaitable], window: float = MESSAGE_CHANGE_WINDOW):
+        self.flush = flush
+        self.window = window
+        self.edits: Dict[Tuple[int, Optional[int]], Dict[int, Message]] = defaultdict(dict)
+        self.deletes: Dict[Tuple[int, Optional[int]], Set[int]] = defaultdict(set)
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def add_edit(self, account_id: int, chat_id: int, message: Message):
+        self.edits[(account_id, chat_id)][message.id] = message
+        self.schedule()
+
+    def add_delete(self, account_id: int, chat_id: Optional[int], message_ids: List[int]):
+        self.deletes[(account_id, chat_id)].update(message_ids)
+        self.schedule()
+
+    def schedule(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        # 应用期间新增的变更找到的是当前任务，不会另起任务，循环到缓冲为空
+        while self.edits or self.deletes:
+            await asyncio.sleep(self.window)
+            edits, self.edits = self.edits, defaultdict(dict)
+            deletes, self.deletes = self.deletes, defaultdict(set)
+            try:
+                await self.flush(edits, deletes)
+            except Exception as e:
+                LOG.exception(f"Apply message changes failed. Error: {e}")
+
+
+@dataclass
+class SyncJob:
+    """
+    同步作业，priority 越小越先执行
+    """
+    priority: int
+    account_id: int
+    name: str
+    run: Callable[[], Awaitable]
+
+
+class SyncJobRunner:
+    """
+    同步作业调度器
+    1. 全局和单账号并发上限
+    2. 手动同步优先于自动同步，同一优先级内按账号轮转，保证账号之间公平
+    3. 作业之间互相隔离，单个作业失败不影响其他作业
+    """
+
+    def __init__(self, concurrency: int, account_concurrency: int):
+        self.concurrency = max(concurrency, 1)
+        self.account_concurrency = max(account_concurrency, 1)
+
+    @classmethod
+    def order(cls, jobs: List[SyncJob]) -> List[SyncJob]:
+        """
+        按优先级排序，同一优先级内轮流取各账号的作业
+        :param jobs:
+        :return:
+        """
+        ordered = []
+        for priority in sorted({job.priority for job in jobs}):
+            queues = defaultdict(list)
+            for job in jobs:
+                if job.priority == priority:
+                    queues[job.account_id].append(job)
+            queues = list(queues.values())
+            while queues:
+                ordered.extend(queue.pop(0) for queue in queues)
+                queues = [queue for queue in queues if queue]
+        return ordered
+
+    async def run(self, jobs: List[SyncJob]) -> Tuple[int, int]:
+        """
+        运行所有作业
+        :param jobs:
+        :return: (成功数, 失败数)
+        """
+        pending = self.order(jobs)
+        running: Dict[asyncio.Task, SyncJob] = {}
+        account_running = Counter()
+        succeeded = failed = 0
+        while pending or running:
+            # 按顺序启动未超过并发上限的作业，账号已满时跳过，避免阻塞其他账号
+            for job in list(pending):
+                if len(running) >= self.concurrency:
+                    break
+                if account_running[job.account_id] >= self.account_concurrency:
+                    continue
+                pending.remove(job)
+                account_running[job.account_id] += 1
+                LOG.info(f"Start sync job. Job: {job.name}")
+                running[asyncio.create_task(job.run())] = job
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                account_running[job.account_id] -= 1
+                if (error := future.exception()) is not None:
+                    failed += 1
+                    LOG.opt(exception=error).error(f"Sync job failed. Job: {job.name}, Error: {error}")
+                else:
+                    succeeded += 1
+        return succeeded, failed
 
 
 class DialogMessageSync(BaseDBScript, TGClientMethod, SIOClientMethod):
+    schedule_job = every(config_settings.tg.message_sync_interval)
+
     def __init__(self):
-        pass
+        # 禁止转发的源对话，直接逐条复制发送
+        self.forward_restricted: Set[int] = set()
+        # 防止上一轮同步未结束时重复执行
+        self.lock = asyncio.Lock()
+        self.runner = SyncJobRunner(
+            concurrency=config_settings.tg.message_sync_concurrency,
+            account_concurrency=config_settings.tg.message_sync_account_concurrency,
+        )
+        # 同一个同步任务的历史同步和实时投递串行执行
+        self.task_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # 实时同步路由，只包含实时同步任务：账号ID -> 源对话ID -> [(同步任务, 设置)]
+        self.live_routes: Dict[int, Dict[int, List[Tuple[DialogSync, DialogSyncSetting]]]] = {}
+        # 编辑、删除路由，包含全部启用的同步任务：账号ID -> 源对话ID -> [(同步任务, 设置)]
+        self.change_routes: Dict[int, Dict[int, List[Tuple[DialogSync, DialogSyncSetting]]]] = {}
+        # 已注册监听的账号，有启用的同步任务的账号都会注册：账号ID -> (客户端, [事件处理函数])
+        self.live_clients: Dict[int, Tuple[TelegramClient, List[Callable]]] = {}
+        # 源消息的编辑、删除，合并后批量应用到目标对话，实时同步和历史同步的任务都同步编辑和删除
+        self.changes = MessageChangeBuffer(self.apply_message_changes)
+        # 已完成断点补齐、正在实时同步的任务
+        self.live_sync_ids: Set[int] = set()
+        # 上次清理消息映射的时间
+        self.pruned_at = 0.0
 
     @classmethod
     async def get_dialog_sync_tasks(cls) -> List[DialogSync]:
         return await DialogSync.get_queryset().select_related('account', 'from_dialog', 'to_dialog').filter(status=1).all()
 
-    async def sync_dialog_message(self, account, from_dialog, to_dialog, settings):
-        # 初始化TG客户端
-        client = self.get_client(account)
-        await self.start_client(client=client, account=account)
-        # 获取对话实体
-        from_dialog_entity = await client.get_entity(from_dialog.tg_id)
-        to_dialog_entity = await client.get_entity(to_dialog.tg_id)
-        # 获取对话消息
-        async for message in client.iter_messages(from_dialog_entity, reverse=settings.message_reversed):
-            LOG.info(f"Message: {message.to_dict()}")
-            # 跳过系统消息
-            if isinstance(message, MessageService):
+    @classmethod
+    async def save_watermark(cls, task: DialogSync, message_id: int):
+        """
+        推进同步水位，只允许单调递增
+        :param task:
+        :param message_id: 已确认发送成功的源消息ID
+        :return:
+        """
+        await DialogSync.filter(id=task.id, last_message_id__lt=message_id).update(last_message_id=message_id)
+        task.last_message_id = max(task.last_message_id, message_id)
+
+    @classmethod
+    def get_media_id(cls, message: Message) -> Optional[int]:
+        return media.id if (media := message.photo or message.document) else None
+
+    @classmethod
+    def get_content_hash(cls, message: Message) -> int:
+        """
+        消息内容的 64 位指纹，由文本和媒体ID计算
+        :param message:
+        :return:
+        """
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update((message.message or "").encode())
+        if (media_id := cls.get_media_id(message)) is not None:
+            digest.update(str(media_id).encode())
+        return int.from_bytes(digest.digest(), "big", signed=True)
+
+    @classmethod
+    async def save_delivered(cls, task: DialogSync, messages: List[Message], sent_messages: List[Message]):
+        """
+        批量写入消息映射并推进水位，在同一个事务中完成
+        :param task:
+        :param messages: 源消息
+        :param sent_messages: 目标消息，与源消息一一对应，发送失败的为 None
+        :return:
+        """
+        rows = [
+            DialogSyncMessage(
+                sync_id=task.id,
+                source_message_id=message.id,
+                target_message_id=sent.id,
+                grouped_id=message.grouped_id,
+                content_hash=cls.get_content_hash(message),
+                media_id=cls.get_media_id(message),
+            )
+            for message, sent in zip(messages, sent_messages) if sent is not None
+        ]
+        # 租约已被接管时不再推进水位，由接管的进程从水位继续
+        await TG_ACCOUNT_LEASES.check(task.account_id)
+        async with in_transaction():
+            if rows:
+                await DialogSyncMessage.bulk_create(rows, ignore_conflicts=True)
+            await cls.save_watermark(task, messages[-1].id)
+
+    async def prune_message_map(self, interval: int = 24 * 60 * 60):
+        """
+        定期清理超过保留天数的消息映射
+        :param interval: 清理间隔（秒）
+        :return:
+        """
+        if self.pruned_at and time.monotonic() - self.pruned_at < interval:
+            return
+        self.pruned_at = time.monotonic()
+        before = datetime.now() - timedelta(days=config_settings.tg.message_map_retention_days)
+        deleted = await DialogSyncMessage.prune(before)
+        LOG.info(f"Prune message map. Before: {before}, Deleted: {deleted}")
+
+    async def iter_history_pages(self, client, account, entity, min_id: int) -> AsyncIterator[List[Message]]:
+        """
+        按页正序获取历史消息，每页一次限速请求
+        :param client:
+        :param account:
+        :param entity:
+        :param min_id: 只获取大于该ID的消息
+        :return:
+        """
+        while True:
+            messages = await self.call(account, TGRequestType.GET_HISTORY, client.get_messages, entity,
+                                       limit=FORWARD_BATCH_LIMIT, min_id=min_id, reverse=True)
+            if not messages:
+                return
+            yield messages
+            min_id = messages[-1].id
+
+    @classmethod
+    def group_by_source(cls, tasks: List[Tuple[DialogSync, DialogSyncSetting]]):
+        """
+        按 (账号, 源对话) 分组，同一个源对话只读取一次
+        :param tasks:
+        :return:
+        """
+        groups = defaultdict(list)
+        for task, settings in tasks:
+            groups[(task.account_id, task.from_dialog_id)].append((task, settings))
+        return list(groups.values())
+
+    async def sync_dialog_group(self, tasks: List[Tuple[DialogSync, DialogSyncSetting]], live: bool = False):
+        """
+        同步同一源对话的一组任务
+        :param tasks: 同一账号、同一源对话的同步任务
+        :param live: 是否为实时同步任务的补齐，补齐完成后在释放任务锁之前开始实时投递
+        :return:
+        """
+        account, from_dialog = tasks[0][0].account, tasks[0][0].from_dialog
+        # 从连接池获取TG客户端，同一账号的任务共用一个连接
+        async with contextlib.AsyncExitStack() as stack:
+            client = await stack.enter_async_context(self.use_client(account))
+            # 按ID顺序加锁，避免与其他分组死锁
+            for task, _ in sorted(tasks, key=lambda item: item[0].id):
+                await stack.enter_async_context(self.task_locks[task.id])
+
+            for attempt in range(2):
+                try:
+                    # 获取对话实体，优先使用缓存的 access_hash 在本地构造
+                    from_peer = await self.get_input_peer(client, account, from_dialog)
+                    targets = [
+                        (task, settings, await self.get_input_peer(client, account, task.to_dialog))
+                        for task, settings in tasks
+                    ]
+                    failures = await self.sync_history(client, account, from_peer, targets)
+                except INVALID_PEER_ERRORS:
+                    if attempt:
+                        raise
+                    # access_hash 失效，清除缓存后重新解析
+                    await self.invalidate_input_peer(account, from_dialog)
+                    for task, _ in tasks:
+                        await self.invalidate_input_peer(account, task.to_dialog)
+                    continue
+                if live:
+                    # 仍持有任务锁，等待中的实时消息在补齐之后投递，水位之间没有缺口
+                    self.live_sync_ids.update(task.id for task, _ in tasks if task.id not in failures)
+                if not failures:
+                    return
+                tasks = [(task, settings) for task, settings in tasks if task.id in failures]
+                if attempt or not any(isinstance(e, INVALID_PEER_ERRORS) for e in failures.values()):
+                    # 其他目标已正常投递，只将失败的目标作为本组的失败上报
+                    raise next(iter(failures.values()))
+                # 目标的 access_hash 失效，清除缓存后只重试失败的目标
+                for task, _ in tasks:
+                    await self.invalidate_input_peer(account, task.to_dialog)
+
+    async def sync_history(self, client, account, from_peer, targets) -> Dict[int, Exception]:
+        """
+        读取一次源对话历史，并发投递给所有目标对话，每个目标使用自己的水位
+        单个目标投递失败只停止该目标，其他目标继续投递；读取失败时抛出异常
+        :param client:
+        :param account:
+        :param from_peer:
+        :param targets: [(同步任务, 设置, 目标对话 InputPeer)]
+        :return: 投递失败的目标 {同步任务ID: 异常}
+        """
+        if new_live_tasks := [task for task, settings, _ in targets
+                              if settings.only_latest_message and not task.last_message_id]:
+            # 只同步最新消息的任务不回填历史，水位直接从当前最新消息开始
+            latest = await self.call(account, TGRequestType.GET_HISTORY, client.get_messages, from_peer, limit=1)
+            for task in new_live_tasks if latest else []:
+                LOG.info(f"Skip history for live sync. Sync: {task.id}, Latest message id: {latest[0].id}")
+                await self.save_watermark(task, latest[0].id)
+
+        # 从最小的水位之后按消息ID正序获取，保证中途失败后可以从断点继续
+        min_id = min(task.last_message_id for task, _, _ in targets)
+        LOG.info(f"Sync from watermark. Syncs: {[task.id for task, _, _ in targets]}, Min message id: {min_id}")
+        # 获取 -> 过滤、分批 -> 投递，各阶段之间使用有界队列，内存占用与对话大小无关
+        depth = config_settings.tg.pipeline_queue_depth
+        page_queue = asyncio.Queue(maxsize=depth)
+        batch_queues = {task.id: asyncio.Queue(maxsize=depth) for task, _, _ in targets}
+        failures: Dict[int, Exception] = {}
+        await self.run_stages(
+            [
+                self.fetch_stage(client, account, from_peer, min_id, page_queue),
+                self.batch_stage(targets, page_queue, batch_queues, failures),
+            ],
+            [self.deliver_stage(client, from_peer, target, batch_queues[target[0].id], failures) for target in targets],
+        )
+        return failures
+
+    @classmethod
+    async def run_stages(cls, stages, deliver_stages):
+        """
+        并发运行流水线的各个阶段
+        获取、分批阶段失败时取消所有阶段并抛出异常；投递阶段各自处理异常，一个目标失败不影响其他目标
+        :param stages: 获取、分批阶段
+        :param deliver_stages: 每个目标的投递阶段
+        :return:
+        """
+        stage_tasks = [asyncio.create_task(stage) for stage in stages]
+        deliver_tasks = [asyncio.create_task(stage) for stage in deliver_stages]
+        tasks = stage_tasks + deliver_tasks
+        try:
+            done, _ = await asyncio.wait(stage_tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+            await asyncio.gather(*deliver_tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def fetch_stage(self, client, account, from_peer, min_id: int, page_queue: asyncio.Queue):
+        """
+        获取阶段：队列未满时持续预取下一页，与投递并行
+        :param client:
+        :param account:
+        :param from_peer:
+        :param min_id:
+        :param page_queue:
+        :return:
+        """
+        async for page in self.iter_history_pages(client, account, from_peer, min_id):
+            await page_queue.put(page)
+        await page_queue.put(None)
+
+    @classmethod
+    async def batch_stage(cls, targets, page_queue: asyncio.Queue, batch_queues: Dict[int, asyncio.Queue],
+                          failures: Dict[int, Exception]):
+        """
+        过滤、分批阶段：跳过系统消息，按每个目标的水位和批次设置分批，不再为投递失败的目标分批
+        :param targets:
+        :param page_queue:
+        :param batch_queues:
+        :param failures: 投递失败的目标
+        :return:
+        """
+        batchers = {
+            task.id: MessageBatcher(batch_size=settings.batch_size, max_wait=settings.batch_max_wait)
+            for task, settings, _ in targets
+        }
+
+        async def flush(complete: bool = False):
+            for task_id, batcher in batchers.items():
+                if task_id in failures:
+                    continue
+                if (complete or batcher.is_ready()) and (messages := batcher.pop(complete=complete)):
+                    await batch_queues[task_id].put(messages)
+
+        while True:
+            # 有未发送的消息时，最多等待到最早的批次超时
+            waits = [batcher.started_at + batcher.max_wait - time.monotonic()
+                     for batcher in batchers.values() if batcher.messages]
+            try:
+                page = await asyncio.wait_for(page_queue.get(), timeout=max(min(waits), 0) if waits else None)
+            except asyncio.TimeoutError:
+                await flush()
                 continue
-            # 发送消息
-            await client.send_message(to_dialog_entity, message)
+            if page is None:
+                break
+            for message in page:
+                # 跳过系统消息
+                if isinstance(message, MessageService):
+                    continue
+                for task, _, _ in targets:
+                    if task.id not in failures and message.id > task.last_message_id:
+                        batchers[task.id].add(message)
+                await flush()
+        # 发送剩余消息
+        await flush(complete=True)
+        for batch_queue in batch_queues.values():
+            await batch_queue.put(None)
+
+    async def deliver_stage(self, client, from_peer, target, batch_queue: asyncio.Queue,
+                            failures: Dict[int, Exception]):
+        """
+        投递阶段：每个目标一个消费者，按顺序发送批次并推进自己的水位
+        失败时记录到 failures，水位停在最后成功的批次，下一轮从水位继续
+        :param client:
+        :param from_peer:
+        :param target:
+        :param batch_queue:
+        :param failures:
+        :return:
+        """
+        task, settings, to_peer = target
+        try:
+            while (messages := await batch_queue.get()) is not None:
+                await self.deliver_batch(client, task, from_peer, to_peer, messages, settings)
+        except Exception as e:
+            LOG.exception(f"Deliver failed, stop this target. Sync: {task.id}, Error: {e}")
+            failures[task.id] = e
+            # 丢弃该目标剩余的批次，分批阶段不会因队列已满而阻塞
+            while await batch_queue.get() is not None:
+                pass
+
+    @classmethod
+    def split_albums(cls, messages: List[Message]) -> List[List[Message]]:
+        """
+        将连续的同一相册消息合并为一组，其他消息单独一组
+        :param messages:
+        :return:
+        """
+        groups = []
+        for message in messages:
+            if groups and message.grouped_id and groups[-1][-1].grouped_id == message.grouped_id:
+                groups[-1].append(message)
+            else:
+                groups.append([message])
+        return groups
+
+    async def deliver_batch(self, client, task: DialogSync, from_peer, to_peer, messages: List[Message],
+                            settings: DialogSyncSetting):
+        """
+        发送一批消息，一次 forward_messages 调用完成整批转发
+        发送前在 redis 中确认账号租约仍归当前进程并续期，避免与接管的进程重复发送
+        源对话禁止转发时退化为复制发送，相册整组发送，其他消息逐条发送
+        :param client:
+        :param task:
+        :param from_peer:
+        :param to_peer:
+        :param messages:
+        :param settings:
+        :return:
+        """
+        await TG_ACCOUNT_LEASES.check(task.account_id)
+        message_ids = [message.id for message in messages]
+        LOG.info(f"Deliver batch. Sync: {task.id}, Messages: {message_ids[0]}-{message_ids[-1]}, "
+                 f"Count: {len(message_ids)}")
+        if task.from_dialog.tg_id not in self.forward_restricted:
+            try:
+                sent_messages = await self.call(task.account, TGRequestType.SEND, client.forward_messages, to_peer,
+                                                message_ids, from_peer=from_peer, drop_author=settings.drop_author)
+                await self.save_delivered(task, messages, sent_messages)
+                return
+            except errors.ChatForwardsRestrictedError:
+                LOG.warning(f"Forward restricted, fallback to copy. Dialog: {task.from_dialog.tg_id}")
+                self.forward_restricted.add(task.from_dialog.tg_id)
+
+        for group in self.split_albums(messages):
+            # 发送消息，发送成功后才推进水位
+            sent_messages = await self.copy_messages(client, task, to_peer, group)
+            await self.save_delivered(task, group, sent_messages)
+
+    async def copy_messages(self, client, task: DialogSync, to_peer, messages: List[Message]) -> List[Message]:
+        """
+        复制发送消息，相册一次发送
+        禁止转发的对话无法直接引用媒体，图片和文件先下载到媒体缓存再上传，上传结果在多个目标之间复用
+        :param client:
+        :param task:
+        :param to_peer:
+        :param messages: 单条消息或同一相册的消息
+        :return: 发送后的消息，与 messages 一一对应
+        """
+        for attempt in range(2):
+            async with TG_MEDIA_CACHE.use(client, task.account, messages) as cached_media:
+                try:
+                    if len(messages) > 1:
+                        sent_messages = await self.call(
+                            task.account, TGRequestType.SEND, client.send_file, to_peer,
+                            [cached.file for cached in cached_media],
+                            caption=[message.message or "" for message in messages],
+                            formatting_entities=[message.entities or [] for message in messages],
+                        )
+                    elif (cached := cached_media[0]) is not None:
+                        message = messages[0]
+                        sent_messages = [await self.call(
+                            task.account, TGRequestType.SEND, client.send_file, to_peer, cached.file,
+                            caption=message.message or "", formatting_entities=message.entities,
+                            attributes=message.document.attributes if message.document else None,
+                        )]
+                    else:
+                        sent_messages = [await self.call(task.account, TGRequestType.SEND, client.send_message,
+                                                         to_peer, messages[0])]
+                except errors.FileReferenceExpiredError:
+                    if attempt:
+                        raise
+                    # 复用的媒体已过期，重新上传
+                    for cached in cached_media:
+                        if cached is not None:
+                            TG_MEDIA_CACHE.forget_upload(task.account_id, cached)
+                    continue
+                for cached, sent in zip(cached_media, sent_messages):
+                    if cached is not None:
+                        TG_MEDIA_CACHE.remember_upload(task.account_id, cached, sent)
+                return sent_messages
+
+    async def start_live(self, account) -> None:
+        """
+        为账号注册新消息、编辑、删除监听，客户端长期占用，不会被连接池回收
+        :param account:
+        :return:
+        """
+        client = await TG_CLIENT_POOL.hold(account)
+        if account.id in self.live_clients:
+            if self.live_clients[account.id][0] is client:
+                # 已经在监听，连接池已按需重连
+                TG_CLIENT_POOL.release(account.id)
+                return
+            # 连接池中的客户端已被替换，重新注册
+            await self.stop_live(account.id)
+
+        async def on_new_message(event):
+            # 相册由 Album 事件整组处理
+            if not event.message.grouped_id:
+                await self.on_live_message(account.id, event.chat_id, [event.message])
+
+        async def on_album(event):
+            await self.on_live_message(account.id, event.chat_id, event.messages)
+
+        async def on_message_edited(event):
+            if event.chat_id in self.change_routes.get(account.id, {}):
+                self.changes.add_edit(account.id, event.chat_id, event.message)
+
+        async def on_message_deleted(event):
+            self.changes.add_delete(account.id, event.chat_id, event.deleted_ids)
+
+        LOG.info(f"Start live sync. Account: {account.phone}")
+        client.add_event_handler(on_new_message, events.NewMessage())
+        client.add_event_handler(on_album, events.Album())
+        client.add_event_handler(on_message_edited, events.MessageEdited())
+        client.add_event_handler(on_message_deleted, events.MessageDeleted())
+        self.live_clients[account.id] = (client, [on_new_message, on_album, on_message_edited, on_message_deleted])
+
+    async def stop_live(self, account_id: int):
+        client, handlers = self.live_clients.pop(account_id)
+        LOG.info(f"Stop live sync. Account id: {account_id}")
+        for handler in handlers:
+            client.remove_event_handler(handler)
+        TG_CLIENT_POOL.release(account_id)
+
+    async def update_live_routes(self, tasks: List[Tuple[DialogSync, DialogSyncSetting]]):
+        """
+        刷新实时同步和编辑、删除路由，按需注册或注销账号的监听
+        新消息只路由到实时同步任务，编辑和删除路由到全部任务
+        :param tasks: 全部启用的同步任务
+        :return:
+        """
+        routes = defaultdict(lambda: defaultdict(list))
+        change_routes = defaultdict(lambda: defaultdict(list))
+        accounts = {}
+        live_tasks = []
+        for task, settings in tasks:
+            if settings.only_latest_message:
+                routes[task.account_id][task.from_dialog.tg_id].append((task, settings))
+                live_tasks.append((task, settings))
+            change_routes[task.account_id][task.from_dialog.tg_id].append((task, settings))
+            accounts[task.account_id] = task.account
+
+        for account_id in set(self.live_clients) - set(accounts):
+            await self.stop_live(account_id)
+        for account in accounts.values():
+            try:
+                await self.start_live(account)
+            except Exception as e:
+                LOG.exception(f"Start live sync failed. Account: {account.phone}, Error: {e}")
+
+        self.live_routes = {account_id: dict(dialog_routes) for account_id, dialog_routes in routes.items()}
+        self.change_routes = {
+            account_id: dict(dialog_routes) for account_id, dialog_routes in change_routes.items()
+        }
+        self.live_sync_ids &= {task.id for task, _ in live_tasks}
+
+    async def on_live_message(self, account_id: int, chat_id: int, messages: List[Message]):
+        """
+        实时投递新消息
+        :param account_id:
+        :param chat_id: 源对话ID
+        :param messages: 单条消息，或同一相册的全部消息
+        :return:
+        """
+        messages = [message for message in messages if not isinstance(message, MessageService)]
+        routes = self.live_routes.get(account_id, {}).get(chat_id, [])
+        if not messages or not routes or not TG_ACCOUNT_LEASES.owns(account_id):
+            return
+        client = self.live_clients[account_id][0]
+        await asyncio.gather(*(
+            self.deliver_live_messages(client, task, settings, messages)
+            for task, settings in routes
+        ))
+
+    async def deliver_live_messages(self, client, task: DialogSync, settings: DialogSyncSetting,
+                                    messages: List[Message]):
+        async with self.task_locks[task.id]:
+            if task.id not in self.live_sync_ids:
+                # 未补齐或投递失败过，水位之后可能有未发送的消息，推进水位会跳过它们，由下一轮补齐一并发送
+                LOG.info(f"Live sync pending catch-up, skip. Sync: {task.id}, Messages: {[m.id for m in messages]}")
+                return
+            if not (messages := [message for message in messages if message.id > task.last_message_id]):
+                return
+            try:
+                from_peer = await self.get_input_peer(client, task.account, task.from_dialog)
+                to_peer = await self.get_input_peer(client, task.account, task.to_dialog)
+                await self.deliver_batch(client, task, from_peer, to_peer, messages, settings)
+            except Exception as e:
+                # 投递失败时停止实时投递，下一轮从水位重新补齐
+                LOG.exception(f"Live sync failed. Sync: {task.id}, Messages: {[m.id for m in messages]}, Error: {e}")
+                self.live_sync_ids.discard(task.id)
+
+    def get_change_routes(self, account_id: int, chat_id: Optional[int]):
+        """
+        获取源消息变更需要应用到的同步任务
+        频道的删除事件带对话ID；私聊和普通群的消息ID在账号内唯一，删除事件不带对话ID，需要检查所有非频道的源对话
+        :param account_id:
+        :param chat_id:
+        :return:
+        """
+        if not TG_ACCOUNT_LEASES.owns(account_id):
+            return []
+        dialog_routes = self.change_routes.get(account_id, {})
+        if chat_id is not None:
+            return dialog_routes.get(chat_id, [])
+        return [
+            route for from_tg_id, routes in dialog_routes.items()
+            if utils.resolve_id(from_tg_id)[1] is not PeerChannel for route in routes
+        ]
+
+    async def apply_message_changes(self, edits, deletes):
+        """
+        将合并后的编辑、删除应用到目标对话
+        :param edits: {(账号ID, 源对话ID): {源消息ID: 最新的消息}}
+        :param deletes: {(账号ID, 源对话ID): {源消息ID}}
+        :return:
+        """
+        futures = []
+        for (account_id, chat_id), messages in edits.items():
+            for task, settings in self.get_change_routes(account_id, chat_id):
+                futures.append(self.apply_edits(task, settings, list(messages.values())))
+        for (account_id, chat_id), message_ids in deletes.items():
+            for task, settings in self.get_change_routes(account_id, chat_id):
+                futures.append(self.apply_deletes(task, list(message_ids)))
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                LOG.error(f"Apply message change failed. Error: {result}")
+
+    async def apply_edits(self, task: DialogSync, settings: DialogSyncSetting, messages: List[Message]):
+        """
+        同步源消息的编辑，内容指纹未变化的编辑（如浏览量、回应）直接跳过
+        单条编辑失败不影响其他消息，媒体未变化时只编辑文本
+        :param task:
+        :param settings:
+        :param messages:
+        :return:
+        """
+        if not settings.drop_author:
+            # 转发的消息无法编辑
+            return
+        client = self.live_clients[task.account_id][0]
+        async with self.task_locks[task.id]:
+            mappings = {
+                mapping.source_message_id: mapping
+                for mapping in await DialogSyncMessage.filter(
+                    sync_id=task.id, source_message_id__in=[message.id for message in messages]
+                )
+            }
+            to_peer = await self.get_input_peer(client, task.account, task.to_dialog)
+            for message in messages:
+                mapping = mappings.get(message.id)
+                content_hash = self.get_content_hash(message)
+                if mapping is None or mapping.content_hash == content_hash:
+                    continue
+                media_id = self.get_media_id(message)
+                # 旧映射没有记录媒体ID时无法判断，按媒体已变化处理
+                media_changed = media_id is not None and media_id != mapping.media_id
+                LOG.info(f"Apply edit. Sync: {task.id}, Message: {message.id} -> {mapping.target_message_id}, "
+                         f"Media changed: {media_changed}")
+                try:
+                    await self.call(task.account, TGRequestType.SEND, client.edit_message, to_peer,
+                                    mapping.target_message_id, message.message, formatting_entities=message.entities,
+                                    file=(message.photo or message.document) if media_changed else None)
+                except Exception as e:
+                    LOG.exception(f"Apply edit failed. Sync: {task.id}, Message: {message.id}, Error: {e}")
+                    continue
+                await DialogSyncMessage.filter(id=mapping.id).update(content_hash=content_hash, media_id=media_id)
+
+    async def apply_deletes(self, task: DialogSync, message_ids: List[int]):
+        """
+        同步源消息的删除，每批最多 100 条调用一次 delete_messages
+        :param task:
+        :param message_ids:
+        :return:
+        """
+        client = self.live_clients[task.account_id][0]
+        async with self.task_locks[task.id]:
+            mappings = await DialogSyncMessage.filter(sync_id=task.id, source_message_id__in=message_ids)
+            if not mappings:
+                return
+            to_peer = await self.get_input_peer(client, task.account, task.to_dialog)
+            LOG.info(f"Apply deletes. Sync: {task.id}, Count: {len(mappings)}")
+            for start in range(0, len(mappings), FORWARD_BATCH_LIMIT):
+                chunk = mappings[start:start + FORWARD_BATCH_LIMIT]
+                await self.call(task.account, TGRequestType.SEND, client.delete_messages, to_peer,
+                                [mapping.target_message_id for mapping in chunk])
+                await DialogSyncMessage.filter(id__in=[mapping.id for mapping in chunk]).delete()
+
+    async def sync_live_dialog_group(self, tasks: List[Tuple[DialogSync, DialogSyncSetting]]):
+        """
+        实时同步任务首次启动时从水位补齐，之后只依赖新消息事件
+        :param tasks:
+        :return:
+        """
+        await self.sync_dialog_group(tasks, live=True)
 
     async def __call__(self):
-        tasks = await self.get_dialog_sync_tasks()
+        if self.lock.locked():
+            LOG.warning("Previous dialog sync is still running, skip.")
+            return
+        async with self.lock:
+            await self.sync_all()
+
+    @classmethod
+    def make_sync_job(cls, group: List[Tuple[DialogSync, DialogSyncSetting]], func) -> SyncJob:
+        """
+        将一组同步任务包装为作业，组内有手动同步任务时优先执行
+        :param group:
+        :param func:
+        :return:
+        """
+        first = group[0][0]
+        manual = any(task.type == DialogSyncType.MANUAL for task, _ in group)
+        name = f"{first.account.name} {first.from_dialog.title} -> {[task.to_dialog.title for task, _ in group]}"
+        return SyncJob(priority=0 if manual else 1, account_id=first.account_id, name=name, run=lambda: func(group))
+
+    async def balance_accounts(self, tasks: List[DialogSync]) -> List[DialogSync]:
+        """
+        与其他同步进程平分账号，只保留当前进程持有租约的任务
+        :param tasks:
+        :return:
+        """
+        TG_ACCOUNT_LEASES.start_heartbeat()
+        surplus = await TG_ACCOUNT_LEASES.balance({task.account_id for task in tasks})
+        for account_id in surplus:
+            # 先停止监听再释放租约，接管的进程从水位继续
+            if account_id in self.live_clients:
+                await self.stop_live(account_id)
+            await TG_ACCOUNT_LEASES.release(account_id)
+            LOG.info(f"Account lease released. Account id: {account_id}")
+        return [task for task in tasks if TG_ACCOUNT_LEASES.owns(task.account_id)]
+
+    async def sync_all(self):
+        tasks = await self.balance_accounts(await self.get_dialog_sync_tasks())
         LOG.info(f"Dialog sync tasks: {tasks}")
 
-        # 每个任务启动一个协程
-        futures = []
+        history_tasks, live_tasks = [], []
         for task in tasks:
-            LOG.info(f"Syncing dialog: {task.account.name} {task.from_dialog.title} -> {task.to_dialog.title}")
-            settings = DialogSyncSetting(**task.settings)
-            future = self.sync_dialog_message(task.account, task.from_dialog, task.to_dialog, settings)
-            futures.append(future)
-        await asyncio.gather(*futures)
+            settings = DialogSyncSetting(**(task.settings or {}))
+            if settings.only_latest_message:
+                live_tasks.append((task, settings))
+            else:
+                history_tasks.append((task, settings))
+        # 先注册监听再补齐，补齐期间到达的新消息、编辑和删除不会丢失
+        await self.update_live_routes(history_tasks + live_tasks)
+
+        # 同一源对话的任务合并为一组，每组一个作业
+        jobs = [self.make_sync_job(group, self.sync_dialog_group) for group in self.group_by_source(history_tasks)]
+        pending_live_tasks = [(task, settings) for task, settings in live_tasks if task.id not in self.live_sync_ids]
+        jobs += [
+            self.make_sync_job(group, self.sync_live_dialog_group) for group in self.group_by_source(pending_live_tasks)
+        ]
+        succeeded, failed = await self.runner.run(jobs)
+        LOG.info(f"Dialog sync finished. Succeeded: {succeeded}, Failed: {failed}")
+        # 输出各账号当前速率，供监控查看
+        await TG_RATE_LIMITER.report()
+        await self.prune_message_map()
 
 
 async def main():
+    if config_settings.tg.client_manager:
+        # 消息同步的历史读取、发送和实时监听还未接入客户端管理进程的 RPC，仍使用自己的连接
+        # 与管理进程同时连接同一账号会共用会话，可能触发 AUTH_KEY_DUPLICATED
+        LOG.error("Message sync does not support client_manager yet, set tg.client_manager = false to run it.")
+        return
+
     script = DialogMessageSync()
 
     await script.init_db()
 
-    await script()
-
-    await script.close_db()
+    try:
+        # 首次执行时注册定时任务
+        await script()
+        await SCRIPT_SCHEDULER.run()
+    finally:
+        await SCRIPT_SCHEDULER.shutdown()
+        for account_id in list(script.live_clients):
+            await script.stop_live(account_id)
+        await TG_ACCOUNT_LEASES.close()
+        await TG_CLIENT_POOL.close_all()
+        await script.close_db()
 
 
 if __name__ == '__main__':
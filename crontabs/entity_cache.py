@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from telethon import TelegramClient, errors, utils
+from telethon.tl.types import (
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerUser,
+    PeerChannel,
+    PeerChat,
+    TypeInputPeer,
+)
+
+from app.tg.models import Account, Dialog
+from cores.constant.tg import TGRequestType
+from cores.log import LOG
+from crontabs.rate_limiter import TG_RATE_LIMITER
+
+# access_hash 失效时 TG 返回的错误
+INVALID_PEER_ERRORS = (errors.ChannelInvalidError, errors.PeerIdInvalidError, errors.UserIdInvalidError)
+
+
+class TGEntityCache:
+    """
+    TG实体缓存
+    查找顺序：进程内 LRU -> 数据库 tg_dialogs.access_hash -> TG服务端
+    只有缓存未命中或 access_hash 失效时才请求 TG
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.peers: "OrderedDict[Tuple[int, int], TypeInputPeer]" = OrderedDict()
+
+    @classmethod
+    def build_input_peer(cls, tg_id: int, access_hash: Optional[int]) -> Optional[TypeInputPeer]:
+        """
+        根据对话ID和 access_hash 在本地构造 InputPeer
+        :param tg_id: 带类型标记的对话ID
+        :param access_hash:
+        :return:
+        """
+        real_id, peer_type = utils.resolve_id(tg_id)
+        if peer_type is PeerChat:
+            return InputPeerChat(chat_id=real_id)
+        if access_hash is None:
+            return None
+        if peer_type is PeerChannel:
+            return InputPeerChannel(channel_id=real_id, access_hash=access_hash)
+        return InputPeerUser(user_id=real_id, access_hash=access_hash)
+
+    def get(self, account_id: int, tg_id: int) -> Optional[TypeInputPeer]:
+        key = (account_id, tg_id)
+        if (peer := self.peers.get(key)) is not None:
+            self.peers.move_to_end(key)
+        return peer
+
+    def put(self, account_id: int, tg_id: int, peer: TypeInputPeer):
+        self.peers[(account_id, tg_id)] = peer
+        self.peers.move_to_end((account_id, tg_id))
+        while len(self.peers) > self.max_size:
+            self.peers.popitem(last=False)
+
+    async def invalidate(self, account_id: int, dialog: Dialog):
+        """
+        access_hash 失效时清除缓存
+        :param account_id:
+        :param dialog:
+        :return:
+        """
+        LOG.warning(f"Invalidate entity cache. Account id: {account_id}, Dialog: {dialog.tg_id}")
+        self.peers.pop((account_id, dialog.tg_id), None)
+        dialog.access_hash = None
+        await Dialog.filter(account_id=account_id, tg_id=dialog.tg_id).update(access_hash=None)
+
+    async def get_input_peer(self, client: TelegramClient, account: Account, dialog: Dialog) -> TypeInputPeer:
+        """
+        获取对话的 InputPeer
+        :param client:
+        :param account:
+        :param dialog:
+        :return:
+        """
+        if (peer := self.get(account.id, dialog.tg_id)) is not None:
+            return peer
+        if (peer := self.build_input_peer(dialog.tg_id, dialog.access_hash)) is not None:
+            self.put(account.id, dialog.tg_id, peer)
+            return peer
+
+        # 缓存未命中，向 TG 解析并写回数据库
+        LOG.info(f"Entity cache miss. Account: {account.phone}, Dialog: {dialog.tg_id}")
+        peer = await TG_RATE_LIMITER.call(account.id, TGRequestType.GET_ENTITY, client.get_input_entity,
+                                          dialog.tg_id)
+        dialog.access_hash = getattr(peer, "access_hash", None)
+        await Dialog.filter(account_id=account.id, tg_id=dialog.tg_id).update(access_hash=dialog.access_hash)
+        self.put(account.id, dialog.tg_id, peer)
+        return peer
+
+
+TG_ENTITY_CACHE = TGEntityCache()
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import math
+import os
+import socket
+import time
+import uuid
+from typing import Iterable, Set, Optional
+
+from cores.config import settings
+from cores.constant.tg import TG_SYNC_LEASE_KEY, TG_SYNC_WORKERS_KEY
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+# 仅当租约仍归当前进程所有时才续期/释放
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class AccountLeaseLostError(Exception):
+    """账号租约已被其他进程接管"""
+
+
+class AccountLeaseManager:
+    """
+    账号租约，多个同步进程按账号分片
+    1. 每个账号同一时间只归一个进程所有，租约带过期时间，后台定时续期
+    2. 进程定时上报心跳，按在线进程数平分账号，多出的租约在下一轮释放给其他进程
+    3. 进程退出或宕机后租约过期，其他进程在下一轮接管
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = max(ttl, 3)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.owned: Set[int] = set()
+        self.heartbeat_task: Optional[asyncio.Task] = None
+
+    def owns(self, account_id: int) -> bool:
+        return account_id in self.owned
+
+    async def check(self, account_id: int):
+        """
+        在 redis 中确认租约仍归当前进程并续期，发送和写入水位前调用
+        续期后租约至少在 ttl 内有效，其他进程在此期间无法接管
+        :param account_id:
+        :return:
+        """
+        key = TG_SYNC_LEASE_KEY.format(account_id=account_id)
+        if account_id not in self.owned or not await ASYNC_REDIS.eval(
+                RENEW_SCRIPT, 1, key, self.worker_id, self.ttl * 1000
+        ):
+            self.owned.discard(account_id)
+            raise AccountLeaseLostError(f"Account lease lost. Account id: {account_id}")
+
+    def rank(self, account_id: int) -> str:
+        """各进程对账号的抢占顺序不同，减少争抢"""
+        return hashlib.sha1(f"{self.worker_id}:{account_id}".encode()).hexdigest()
+
+    async def count_workers(self) -> int:
+        now = time.time()
+        await ASYNC_REDIS.zadd(TG_SYNC_WORKERS_KEY, {self.worker_id: now})
+        await ASYNC_REDIS.zremrangebyscore(TG_SYNC_WORKERS_KEY, 0, now - self.ttl)
+        return max(await ASYNC_REDIS.zcard(TG_SYNC_WORKERS_KEY), 1)
+
+    async def renew(self) -> Set[int]:
+        """
+        续期所有租约
+        :return: 已丢失的账号ID
+        """
+        lost = set()
+        for account_id in list(self.owned):
+            key = TG_SYNC_LEASE_KEY.format(account_id=account_id)
+            if not await ASYNC_REDIS.eval(RENEW_SCRIPT, 1, key, self.worker_id, self.ttl * 1000):
+                lost.add(account_id)
+        if lost:
+            LOG.warning(f"Account lease lost. Worker: {self.worker_id}, Account ids: {lost}")
+            self.owned -= lost
+        return lost
+
+    async def release(self, account_id: int):
+        self.owned.discard(account_id)
+        key = TG_SYNC_LEASE_KEY.format(account_id=account_id)
+        await ASYNC_REDIS.eval(RELEASE_SCRIPT, 1, key, self.worker_id)
+
+    async def release_all(self):
+        for account_id in list(self.owned):
+            await self.release(account_id)
+        await ASYNC_REDIS.zrem(TG_SYNC_WORKERS_KEY, self.worker_id)
+
+    async def balance(self, account_ids: Iterable[int]) -> Set[int]:
+        """
+        按在线进程数重新分配账号，需要在没有同步作业运行时调用
+        :param account_ids: 所有待同步的账号ID
+        :return: 需要释放的账号ID，调用方停止相关同步后再调用 release
+        """
+        account_ids = set(account_ids)
+        await self.renew()
+        share = math.ceil(len(account_ids) / await self.count_workers())
+
+        # 账号已删除或超过份额时让出，份额内保留排序靠前的账号
+        kept = sorted(self.owned & account_ids, key=self.rank)[:share]
+        surplus = self.owned - set(kept)
+
+        for account_id in sorted(account_ids - self.owned, key=self.rank):
+            if len(kept) >= share:
+                break
+            key = TG_SYNC_LEASE_KEY.format(account_id=account_id)
+            if await ASYNC_REDIS.set(key, self.worker_id, nx=True, px=self.ttl * 1000):
+                self.owned.add(account_id)
+                kept.append(account_id)
+                LOG.info(f"Account lease acquired. Worker: {self.worker_id}, Account id: {account_id}")
+        return surplus
+
+    def start_heartbeat(self):
+        if self.heartbeat_task is None or self.heartbeat_task.done():
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    async def heartbeat(self):
+        """同步作业可能运行较久，后台定时续期"""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.count_workers()
+                await self.renew()
+            except Exception as e:
+                LOG.exception(f"Account lease heartbeat failed. Worker: {self.worker_id}, Error: {e}")
+
+    async def close(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        await self.release_all()
+
+
+TG_ACCOUNT_LEASES = AccountLeaseManager(ttl=settings.tg.sync_lease_ttl)
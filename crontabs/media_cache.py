@@ -0,0 +1,234 @@
+import asyncio
+import contextlib
+import hashlib
+import os
+import uuid
+from collections import OrderedDict, defaultdict, Counter
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union, List, AsyncIterator
+
+from telethon import TelegramClient, utils
+from telethon.tl.types import Message, TypeInputMedia
+
+from app.tg.models import Account
+from cores.config import settings
+from cores.constant.tg import TGRequestType, TG_MEDIA_INDEX_KEY
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+from crontabs.rate_limiter import TG_RATE_LIMITER
+
+
+@dataclass
+class CachedMedia:
+    """
+    缓存的媒体
+    file 为首次上传后可复用的 InputMedia，或者本地缓存文件路径
+    """
+    content_hash: str
+    file: Union[TypeInputMedia, str]
+
+
+class TGMediaCache:
+    """
+    媒体文件缓存
+    1. 文件按内容哈希存放在 file_save_path/media 下，TG媒体ID到内容哈希的映射存放在 redis 中
+    2. 超出容量时按最近使用时间淘汰，发送中使用的文件被固定，不会被淘汰
+    3. 首次上传后的 InputMedia 在进程内按 (账号, 内容哈希) 复用，同一文件发往多个目标只上传一次
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = os.path.join(root, "media")
+        self.max_bytes = max_bytes
+        # 内容哈希 -> (文件路径, 文件大小)，按最近使用排序
+        self.files: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.uploaded: Dict[Tuple[int, str], TypeInputMedia] = {}
+        # 内容哈希 -> 正在使用的次数
+        self.pins: Counter = Counter()
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        # 同一账号同一媒体串行使用，保证发往多个目标时只上传一次
+        self.media_locks: Dict[Tuple[int, int], asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def load(self):
+        """扫描缓存目录，按修改时间恢复 LRU 顺序"""
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path) and not name.startswith("."):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, os.path.splitext(name)[0], path, stat.st_size))
+        for _, content_hash, path, size in sorted(entries):
+            self.files[content_hash] = (path, size)
+            self.total_bytes += size
+        self.loaded = True
+        LOG.info(f"Media cache loaded. Files: {len(self.files)}, Size: {self.total_bytes}")
+
+    @classmethod
+    def get_media_id(cls, message: Message) -> Optional[int]:
+        if media := message.photo or message.document:
+            return media.id
+        return None
+
+    @classmethod
+    def hash_file(cls, path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def touch_file(cls, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        os.utime(path)
+        return True
+
+    @classmethod
+    def remove_files(cls, paths: List[str]):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def touch(self, content_hash: str) -> Optional[str]:
+        """
+        标记最近使用并固定，文件已被删除时返回 None
+        :param content_hash:
+        :return: 文件路径
+        """
+        if content_hash not in self.files:
+            return None
+        self.files.move_to_end(content_hash)
+        self.pins[content_hash] += 1
+        path, size = self.files[content_hash]
+        if not await asyncio.to_thread(self.touch_file, path):
+            self.unpin(content_hash)
+            if self.files.pop(content_hash, None) is not None:
+                self.total_bytes -= size
+            return None
+        return path
+
+    def unpin(self, content_hash: str):
+        self.pins[content_hash] -= 1
+        if self.pins[content_hash] <= 0:
+            del self.pins[content_hash]
+
+    async def evict(self):
+        """按最近使用顺序淘汰未固定的文件，直到不超过容量"""
+        removed = []
+        for content_hash in list(self.files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self.pins[content_hash]:
+                continue
+            path, size = self.files.pop(content_hash)
+            self.total_bytes -= size
+            self.uploaded = {key: value for key, value in self.uploaded.items() if key[1] != content_hash}
+            LOG.info(f"Evict cached media. Hash: {content_hash}, Size: {size}")
+            removed.append(path)
+        if removed:
+            await asyncio.to_thread(self.remove_files, removed)
+
+    async def download(self, client: TelegramClient, account: Account, message: Message) -> Tuple[str, str]:
+        """
+        下载媒体并按内容哈希存入缓存，返回的文件已固定
+        :param client:
+        :param account:
+        :param message:
+        :return: (内容哈希, 文件路径)
+        """
+        extension = utils.get_extension(message.media)
+        temp_path = os.path.join(self.root, f".{uuid.uuid4().hex}{extension}")
+        await TG_RATE_LIMITER.call(account.id, TGRequestType.DOWNLOAD, client.download_media, message,
+                                   file=temp_path)
+        content_hash = await asyncio.to_thread(self.hash_file, temp_path)
+        if path := await self.touch(content_hash):
+            await asyncio.to_thread(os.remove, temp_path)
+            return content_hash, path
+
+        path = os.path.join(self.root, f"{content_hash}{extension}")
+        await asyncio.to_thread(os.replace, temp_path, path)
+        size = await asyncio.to_thread(os.path.getsize, path)
+        self.files[content_hash] = (path, size)
+        self.total_bytes += size
+        self.pins[content_hash] += 1
+        await self.evict()
+        return content_hash, path
+
+    async def get(self, client: TelegramClient, account: Account, message: Message) -> CachedMedia:
+        """
+        获取消息媒体并固定，优先复用已上传的媒体，其次使用本地缓存，最后才下载，用完后需要 unpin
+        :param client:
+        :param account:
+        :param message:
+        :return:
+        """
+        async with self.lock:
+            if not self.loaded:
+                await asyncio.to_thread(self.load)
+
+        media_id = self.get_media_id(message)
+        if content_hash := await ASYNC_REDIS.hget(TG_MEDIA_INDEX_KEY, str(media_id)):
+            if uploaded := self.uploaded.get((account.id, content_hash)):
+                self.pins[content_hash] += 1
+                return CachedMedia(content_hash=content_hash, file=uploaded)
+            if path := await self.touch(content_hash):
+                return CachedMedia(content_hash=content_hash, file=path)
+
+        LOG.info(f"Media cache miss. Account: {account.phone}, Media id: {media_id}")
+        content_hash, path = await self.download(client, account, message)
+        await ASYNC_REDIS.hset(TG_MEDIA_INDEX_KEY, str(media_id), content_hash)
+        if uploaded := self.uploaded.get((account.id, content_hash)):
+            return CachedMedia(content_hash=content_hash, file=uploaded)
+        return CachedMedia(content_hash=content_hash, file=path)
+
+    @contextlib.asynccontextmanager
+    async def use(self, client: TelegramClient, account: Account,
+                  messages: List[Message]) -> AsyncIterator[List[Optional[CachedMedia]]]:
+        """
+        使用消息媒体发送，使用期间同一媒体的其他发送会等待，以便复用本次上传的结果
+        使用期间文件被固定，不会被淘汰
+        :param client:
+        :param account:
+        :param messages:
+        :return: 与消息一一对应，没有图片或文件的消息为 None
+        """
+        media_ids = sorted({media_id for message in messages if (media_id := self.get_media_id(message))})
+        async with contextlib.AsyncExitStack() as stack:
+            for media_id in media_ids:
+                await stack.enter_async_context(self.media_locks[(account.id, media_id)])
+            cached_media = []
+            try:
+                for message in messages:
+                    cached = await self.get(client, account, message) if self.get_media_id(message) else None
+                    cached_media.append(cached)
+                yield cached_media
+            finally:
+                for cached in cached_media:
+                    if cached is not None:
+                        self.unpin(cached.content_hash)
+                # 使用期间超出容量的文件在释放后淘汰
+                await self.evict()
+
+    def remember_upload(self, account_id: int, cached: CachedMedia, sent: Optional[Message]):
+        """
+        记录首次上传后的媒体，之后发往其他目标时直接引用
+        :param account_id:
+        :param cached:
+        :param sent: 发送成功的消息
+        :return:
+        """
+        if sent is not None and sent.media is not None and isinstance(cached.file, str):
+            self.uploaded[(account_id, cached.content_hash)] = utils.get_input_media(sent.media)
+
+    def forget_upload(self, account_id: int, cached: CachedMedia):
+        """file_reference 过期时清除已上传的媒体"""
+        self.uploaded.pop((account_id, cached.content_hash), None)
+
+
+TG_MEDIA_CACHE = TGMediaCache(
+    root=settings.tg.file_save_path,
+    max_bytes=settings.tg.media_cache_size_mb * 1024 * 1024,
+)
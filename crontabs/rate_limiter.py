@@ -0,0 +1,189 @@
+import asyncio
+import time
+from collections import defaultdict
+from inspect import isawaitable
+from typing import Dict, Tuple, Callable, AsyncIterator, Any, Hashable
+
+from telethon import errors
+
+from cores.constant.tg import TGRequestType, TG_REQUEST_RATES, TG_RATE_LIMIT_KEY, TG_NO_RETRY_REQUEST_TYPES
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+
+class AdaptiveTokenBucket:
+    """
+    自适应令牌桶
+    1. 成功请求后速率线性回升，直到最大速率
+    2. 遇到 FloodWait 后速率减半，并在服务端要求的等待时间内阻塞当前桶
+    """
+
+    def __init__(self, max_rate: float, min_rate_ratio: float = 1 / 16, increase_ratio: float = 1 / 20):
+        self.max_rate = max_rate
+        self.min_rate = max_rate * min_rate_ratio
+        self.increase_step = max_rate * increase_ratio
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float):
+        # 桶容量为 1 秒的令牌数，至少 1 个
+        capacity = max(self.rate, 1.0)
+        self.tokens = min(capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """获取一个令牌，同一个桶的请求按先后顺序排队"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_flood_wait(self, seconds: float):
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def blocked_for(self) -> float:
+        return max(0.0, self.blocked_until - time.monotonic())
+
+
+class TGRateLimiter:
+    """
+    TG请求限速器
+    每个账号的每种请求类型一个令牌桶，某个账号被限流时不影响其他账号
+    """
+
+    def __init__(self, max_retries: int = 3):
+        self.max_retries = max_retries
+        self.buckets: Dict[Tuple[int, TGRequestType], AdaptiveTokenBucket] = {}
+
+    def bucket(self, account_id: int, request_type: TGRequestType) -> AdaptiveTokenBucket:
+        key = (account_id, request_type)
+        if key not in self.buckets:
+            self.buckets[key] = AdaptiveTokenBucket(max_rate=TG_REQUEST_RATES[request_type])
+        return self.buckets[key]
+
+    async def call(self, account_id: int, request_type: TGRequestType, func, *args, **kwargs):
+        """
+        限速调用，遇到 FloodWait 时按服务端要求的时间等待后重试
+        :param account_id:
+        :param request_type:
+        :param func: 客户端方法
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        bucket = self.bucket(account_id, request_type)
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+                if isawaitable(result):
+                    result = await result
+            except errors.FloodError as e:
+                seconds = getattr(e, "seconds", 0) or 1
+                bucket.on_flood_wait(seconds)
+                LOG.warning(f"Flood wait. Account id: {account_id}, Type: {request_type.value}, "
+                            f"Seconds: {seconds}, Rate: {bucket.rate:.3f}/s")
+                attempt += 1
+                if attempt > self.max_retries or request_type in TG_NO_RETRY_REQUEST_TYPES:
+                    raise
+                continue
+            bucket.on_success()
+            return result
+
+    async def iterate(self, account_id: int, request_type: TGRequestType, func, resume: Callable[[Any], dict],
+                      key: Callable[[Any], Hashable], page_size: int = 100, **kwargs) -> AsyncIterator:
+        """
+        限速迭代，客户端迭代器每 page_size 项发送一次请求，每页获取一个令牌
+        遇到 FloodWait 时等待后从最后一项继续，不从头重新获取
+        :param account_id:
+        :param request_type:
+        :param func: 返回异步迭代器的客户端方法，如 client.iter_dialogs
+        :param resume: 根据最后一项生成继续迭代的参数
+        :param key: 去重的键，继续迭代时可能重复返回边界上的项
+        :param page_size: 客户端每次请求返回的项数
+        :param kwargs:
+        :return:
+        """
+        bucket = self.bucket(account_id, request_type)
+        seen = set()
+        offset = {}
+        attempt = 0
+        while True:
+            # 继续迭代的参数覆盖调用方传入的同名参数
+            iterator = func(**{**kwargs, **offset}).__aiter__()
+            count = 0
+            try:
+                while True:
+                    if count % page_size == 0:
+                        await bucket.acquire()
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        bucket.on_success()
+                        return
+                    count += 1
+                    if count % page_size == 0:
+                        bucket.on_success()
+                    if (item_key := key(item)) in seen:
+                        continue
+                    seen.add(item_key)
+                    offset = resume(item)
+                    yield item
+            except errors.FloodError as e:
+                seconds = getattr(e, "seconds", 0) or 1
+                bucket.on_flood_wait(seconds)
+                LOG.warning(f"Flood wait. Account id: {account_id}, Type: {request_type.value}, "
+                            f"Seconds: {seconds}, Rate: {bucket.rate:.3f}/s, Resume after: {len(seen)}")
+                attempt += 1
+                if attempt > self.max_retries or request_type in TG_NO_RETRY_REQUEST_TYPES:
+                    raise
+
+    def snapshot(self) -> Dict[int, Dict[str, dict]]:
+        """
+        当前各账号各请求类型的速率
+        :return:
+        """
+        data = defaultdict(dict)
+        for (account_id, request_type), bucket in self.buckets.items():
+            data[account_id][request_type.value] = {
+                "rate": round(bucket.rate, 3),
+                "max_rate": bucket.max_rate,
+                "blocked_for": round(bucket.blocked_for, 1),
+            }
+        return dict(data)
+
+    async def report(self, expire: int = 600):
+        """
+        将当前速率写入 redis，供监控查看
+        :param expire:
+        :return:
+        """
+        for account_id, rates in self.snapshot().items():
+            name = TG_RATE_LIMIT_KEY.format(account_id=account_id)
+            mapping = {
+                request_type: f"{data['rate']}/{data['max_rate']} blocked:{data['blocked_for']}s"
+                for request_type, data in rates.items()
+            }
+            LOG.info(f"Rate limit. Account id: {account_id}, Rates: {mapping}")
+            await ASYNC_REDIS.hset(name, mapping=mapping)
+            await ASYNC_REDIS.expire(name, expire)
+
+
+TG_RATE_LIMITER = TGRateLimiter()
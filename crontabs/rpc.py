@@ -0,0 +1,101 @@
+import base64
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional
+
+from telethon.extensions import BinaryReader
+from telethon.tl.tlobject import TLObject
+
+from app.tg.models import Account
+from cores.constant.tg import TG_RPC_REQUEST_KEY, TG_RPC_REPLY_KEY
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+from crontabs.base import DialogDifference
+
+
+class TGRPCError(Exception):
+    """客户端管理进程返回错误或超时"""
+
+
+@dataclass
+class RPCDialog:
+    """
+    客户端管理进程返回的对话
+    """
+    id: int
+    entity: TLObject
+
+
+def encode_tl(obj: TLObject) -> str:
+    """TL 对象按协议格式序列化，跨进程传输后可还原为原始类型"""
+    return base64.b64encode(bytes(obj)).decode()
+
+
+def decode_tl(data: str) -> TLObject:
+    with BinaryReader(base64.b64decode(data)) as reader:
+        return reader.tgread_object()
+
+
+class TGRPCClient:
+    """
+    客户端管理进程的 RPC 客户端
+    请求推入 redis 请求队列，回复写入请求专属的列表，通过 BLPOP 等待
+    """
+
+    def __init__(self, timeout: int = 60):
+        self.timeout = timeout
+
+    async def call(self, method: str, account: Account, timeout: int = None, **params):
+        """
+        调用客户端管理进程
+        :param method: 方法名
+        :param account:
+        :param timeout: 等待回复的秒数
+        :param params:
+        :return:
+        """
+        request_id = uuid.uuid4().hex
+        timeout = timeout or self.timeout
+        # 超过截止时间仍未处理的请求由管理进程丢弃
+        request = {"id": request_id, "method": method, "account_id": account.id, "params": params,
+                   "expires_at": time.time() + timeout}
+        await ASYNC_REDIS.rpush(TG_RPC_REQUEST_KEY, json.dumps(request))
+        result = await ASYNC_REDIS.blpop([TG_RPC_REPLY_KEY.format(request_id=request_id)], timeout=timeout)
+        if result is None:
+            raise TGRPCError(f"RPC timeout. Method: {method}, Account: {account.phone}")
+        reply = json.loads(result[1])
+        if error := reply.get("error"):
+            LOG.error(f"RPC failed. Method: {method}, Account: {account.phone}, Error: {error}")
+            raise TGRPCError(error)
+        return reply["result"]
+
+    async def connect(self, account: Account) -> bool:
+        """让管理进程连接账号，登录完成后调用，返回是否已授权"""
+        return await self.call("connect", account)
+
+    async def get_dialogs(self, account: Account) -> List[RPCDialog]:
+        dialogs = await self.call("get_dialogs", account)
+        return [RPCDialog(id=dialog["id"], entity=decode_tl(dialog["entity"])) for dialog in dialogs]
+
+    async def get_update_state(self, account: Account) -> dict:
+        return await self.call("get_update_state", account)
+
+    async def get_dialog_difference(self, account: Account, state: dict) -> Optional[DialogDifference]:
+        """
+        获取上次同步以来变化的对话，状态过旧时返回 None
+        :param account:
+        :param state:
+        :return:
+        """
+        if (result := await self.call("get_dialog_difference", account, state=state)) is None:
+            return None
+        return DialogDifference(
+            entities={int(tg_id): decode_tl(entity) for tg_id, entity in result["entities"].items()},
+            peer_ids=set(result["peer_ids"]),
+            state=result["state"],
+        )
+
+
+TG_RPC_CLIENT = TGRPCClient()
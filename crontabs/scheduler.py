@@ -0,0 +1,237 @@
+import asyncio
+import math
+import random
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Awaitable, List, Set, Optional
+
+from cores.log import LOG
+
+
+class Trigger(ABC):
+    """触发器，计算下一次触发的时间戳，需要子类实现 get_next"""
+
+    @abstractmethod
+    def get_next(self, now: float) -> Optional[float]:
+        """
+        严格晚于 now 的下一次触发时间
+        :param now: 时间戳
+        :return: 不再触发时返回 None
+        """
+
+
+class IntervalTrigger(Trigger):
+    """固定间隔触发，按创建时间对齐，执行耗时不会累积为漂移"""
+
+    def __init__(self, seconds: float):
+        assert seconds > 0, "间隔必须大于 0"
+        self.seconds = seconds
+        self.anchor = time.time()
+
+    def get_next(self, now: float) -> Optional[float]:
+        # 错过的多次触发合并为一次
+        return self.anchor + (math.floor((now - self.anchor) / self.seconds) + 1) * self.seconds
+
+    def __repr__(self):
+        return f"every {self.seconds}s"
+
+
+class CronTrigger(Trigger):
+    """
+    cron 表达式触发，按本地时间计算
+    格式：分 时 日 月 周，支持 *、a-b、*/n、a-b/n 和逗号分隔的列表，周日为 0 或 7
+    日和周同时指定时满足任一即触发，与 crontab 一致
+    """
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid cron expression: {expression}")
+        self.expression = expression
+        fields = [self.parse_field(part, low, high) for part, (low, high) in zip(parts, self.FIELD_RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        # 周日统一为 0，与 isoweekday() % 7 一致
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @classmethod
+    def parse_field(cls, part: str, low: int, high: int) -> Set[int]:
+        values = set()
+        for item in part.split(","):
+            value_range, _, step = item.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = map(int, value_range.split("-", 1))
+            else:
+                start = end = int(value_range)
+                # 单个值带步长时从该值开始到最大值
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field out of range: {part}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def match_day(self, moment: datetime) -> bool:
+        day_matched = moment.day in self.days
+        weekday_matched = moment.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_matched and weekday_matched
+        return day_matched or weekday_matched
+
+    def get_next(self, now: float) -> Optional[float]:
+        moment = datetime.fromtimestamp(now).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 逐级跳过不匹配的月、日、时、分，最多向后查找 5 年
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        return None
+
+    def __repr__(self):
+        return f"cron {self.expression}"
+
+
+@dataclass
+class ScheduleJob:
+    """
+    定时任务配置
+    jitter: 每次触发随机推迟 0 ~ jitter 秒，避免多个进程同时执行
+    max_instances: 同时运行的实例上限，达到上限时跳过本次触发
+    misfire_grace: 触发延迟超过该秒数时跳过本次，None 表示总是补执行
+    """
+    trigger: Trigger
+    jitter: float = 0
+    max_instances: int = 1
+    misfire_grace: Optional[float] = None
+    name: Optional[str] = None
+    func: Optional[Callable[[], Awaitable]] = None
+    next_fire: Optional[float] = None  # 不含 jitter 的触发时间
+    run_at: Optional[float] = None  # 加上 jitter 后的实际执行时间
+    running: Set[asyncio.Task] = field(default_factory=set)
+
+    def schedule_next(self, now: float):
+        self.next_fire = self.trigger.get_next(now)
+        if self.next_fire is None:
+            self.run_at = None
+            return
+        self.run_at = self.next_fire + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+
+def every(seconds: float, **options) -> ScheduleJob:
+    return ScheduleJob(trigger=IntervalTrigger(seconds), **options)
+
+
+def cron(expression: str, **options) -> ScheduleJob:
+    return ScheduleJob(trigger=CronTrigger(expression), **options)
+
+
+class AsyncScheduler:
+    """
+    asyncio 定时任务调度
+    1. 休眠到最近一个任务的执行时间，新增任务时立即唤醒重新计算，不依赖固定轮询
+    2. 每个任务的运行实例都被跟踪，超过 max_instances 时跳过，慢任务不会堆积
+    3. 关闭时等待运行中的任务结束，超时后取消
+    """
+
+    def __init__(self):
+        self.jobs: List[ScheduleJob] = []
+        self.wakeup = asyncio.Event()
+        self.stopped = False
+
+    def add_job(self, func: Callable[[], Awaitable], job: ScheduleJob) -> ScheduleJob:
+        """
+        添加任务
+        :param func: 每次触发时调用，返回 awaitable
+        :param job:
+        :return:
+        """
+        job.func = func
+        job.name = job.name or getattr(func, "__qualname__", repr(func))
+        job.schedule_next(time.time())
+        self.jobs.append(job)
+        self.wakeup.set()
+        LOG.info(f"Schedule job added. Job: {job.name}, Trigger: {job.trigger}, "
+                 f"Next run: {datetime.fromtimestamp(job.run_at) if job.run_at else None}")
+        return job
+
+    def remove_job(self, job: ScheduleJob):
+        if job in self.jobs:
+            self.jobs.remove(job)
+            self.wakeup.set()
+
+    async def run_job(self, job: ScheduleJob):
+        started_at = time.monotonic()
+        try:
+            await job.func()
+        except Exception as e:
+            # 脚本的异常已由 ScriptMeta 处理，这里兜底避免任务异常无人处理
+            LOG.exception(f"Schedule job failed. Job: {job.name}, Error: {e}")
+        else:
+            LOG.debug(f"Schedule job finished. Job: {job.name}, Elapsed: {time.monotonic() - started_at:.2f}s")
+
+    def dispatch(self, job: ScheduleJob, now: float):
+        delay = now - job.run_at
+        if job.misfire_grace is not None and delay > job.misfire_grace:
+            LOG.warning(f"Schedule job misfired, skip. Job: {job.name}, Delay: {delay:.2f}s")
+        elif len(job.running) >= job.max_instances:
+            LOG.warning(f"Schedule job still running, skip. Job: {job.name}, Instances: {len(job.running)}")
+        else:
+            task = asyncio.create_task(self.run_job(job))
+            job.running.add(task)
+            task.add_done_callback(job.running.discard)
+        job.schedule_next(max(now, job.next_fire))
+
+    async def run(self):
+        """调度循环，直到 shutdown"""
+        self.stopped = False
+        while not self.stopped:
+            self.wakeup.clear()
+            now = time.time()
+            for job in [job for job in self.jobs if job.run_at is not None and job.run_at <= now]:
+                self.dispatch(job, now)
+            self.jobs = [job for job in self.jobs if job.run_at is not None or job.running]
+            run_times = [job.run_at for job in self.jobs if job.run_at is not None]
+            timeout = max(min(run_times) - time.time(), 0) if run_times else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def shutdown(self, wait: bool = True, timeout: Optional[float] = 30):
+        """
+        停止调度
+        :param wait: 是否等待运行中的任务结束
+        :param timeout: 等待的最长秒数，超时后取消
+        :return:
+        """
+        self.stopped = True
+        self.wakeup.set()
+        running = {task for job in self.jobs for task in job.running}
+        if not running:
+            return
+        if wait:
+            LOG.info(f"Wait for schedule jobs. Running: {len(running)}")
+            _, running = await asyncio.wait(running, timeout=timeout)
+        for task in running:
+            task.cancel()
+        if running:
+            LOG.warning(f"Schedule jobs cancelled. Cancelled: {len(running)}")
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+SCRIPT_SCHEDULER = AsyncScheduler()
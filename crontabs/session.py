@@ -0,0 +1,282 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Dict, Tuple, Optional
+
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, SQLiteSession
+from telethon.tl.types import updates
+
+from app.tg.models import TGSession, TGSessionEntity
+from cores.constant.tg import TG_SESSION_KEY, TG_SESSION_ENTITIES_KEY
+from cores.log import LOG
+from cores.redis import ASYNC_REDIS
+
+# (id, hash, username, phone, name)，与 MemorySession 的实体行一致
+EntityRow = Tuple[int, int, Optional[str], Optional[str], Optional[str]]
+
+
+class SessionStore(ABC):
+    """
+    会话存储，按手机号读写
+    state: {"dc_id", "server_address", "port", "auth_key", "takeout_id", "update_states"}
+    update_states: {实体ID: [pts, qts, date 时间戳, seq]}
+    """
+
+    @abstractmethod
+    async def load(self, phone: str) -> Tuple[Optional[dict], Dict[int, EntityRow]]:
+        ...
+
+    @abstractmethod
+    async def save(self, phone: str, state: Optional[dict], entities: Dict[int, EntityRow]):
+        """实体按ID覆盖写入"""
+
+    @abstractmethod
+    async def delete(self, phone: str):
+        ...
+
+
+class DBSessionStore(SessionStore):
+    """会话存储在 MySQL"""
+
+    async def load(self, phone: str) -> Tuple[Optional[dict], Dict[int, EntityRow]]:
+        session = await TGSession.get_or_none(phone=phone)
+        if session is None:
+            return None, {}
+        state = {
+            "dc_id": session.dc_id,
+            "server_address": session.server_address,
+            "port": session.port,
+            "auth_key": session.auth_key,
+            "takeout_id": session.takeout_id,
+            "update_states": session.update_states or {},
+        }
+        rows = await TGSessionEntity.filter(session_phone=phone).values_list(
+            "tg_id", "hash", "username", "phone", "name"
+        )
+        return state, {row[0]: tuple(row) for row in rows}
+
+    async def save(self, phone: str, state: Optional[dict], entities: Dict[int, EntityRow]):
+        if state is not None:
+            await TGSession.update_or_create(phone=phone, defaults=state)
+        if entities:
+            await TGSessionEntity.bulk_create(
+                [
+                    TGSessionEntity(session_phone=phone, tg_id=tg_id, hash=hash_, username=username,
+                                    phone=entity_phone, name=name)
+                    for tg_id, hash_, username, entity_phone, name in entities.values()
+                ],
+                on_conflict=["session_phone", "tg_id"],
+                update_fields=["hash", "username", "phone", "name"],
+                batch_size=1000,
+            )
+
+    async def delete(self, phone: str):
+        await TGSessionEntity.filter(session_phone=phone).delete()
+        await TGSession.filter(phone=phone).delete()
+
+
+class RedisSessionStore(SessionStore):
+    """会话存储在 redis，auth_key 以十六进制保存"""
+
+    async def load(self, phone: str) -> Tuple[Optional[dict], Dict[int, EntityRow]]:
+        data = await ASYNC_REDIS.get(TG_SESSION_KEY.format(phone=phone))
+        if data is None:
+            return None, {}
+        state = json.loads(data)
+        state["auth_key"] = bytes.fromhex(state["auth_key"]) if state.get("auth_key") else None
+        rows = await ASYNC_REDIS.hgetall(TG_SESSION_ENTITIES_KEY.format(phone=phone))
+        return state, {int(tg_id): (int(tg_id), *json.loads(row)) for tg_id, row in rows.items()}
+
+    async def save(self, phone: str, state: Optional[dict], entities: Dict[int, EntityRow]):
+        async with ASYNC_REDIS.pipeline(transaction=False) as pipe:
+            if state is not None:
+                state = {**state, "auth_key": state["auth_key"].hex() if state["auth_key"] else None}
+                pipe.set(TG_SESSION_KEY.format(phone=phone), json.dumps(state))
+            if entities:
+                pipe.hset(TG_SESSION_ENTITIES_KEY.format(phone=phone),
+                          mapping={str(tg_id): json.dumps(row[1:]) for tg_id, row in entities.items()})
+            await pipe.execute()
+
+    async def delete(self, phone: str):
+        await ASYNC_REDIS.delete(TG_SESSION_KEY.format(phone=phone), TG_SESSION_ENTITIES_KEY.format(phone=phone))
+
+
+class StoredSession(MemorySession):
+    """
+    存储在数据库或 redis 中的 Telethon 会话
+    1. 创建客户端前调用 load 一次性读取授权信息和实体缓存，之后的读取都在内存中完成
+    2. 授权信息、更新状态和新增实体先标记为待写入，延迟 flush_delay 秒后合并写入，写入期间的变更在之后继续写入
+    3. 任何节点上的进程都可以使用同一账号的会话，不再依赖共享的 session 文件
+    4. 实体按ID保存，access_hash 等变化时覆盖旧的记录
+    """
+
+    def __init__(self, phone: str, store: SessionStore, flush_delay: float = 1.0):
+        super().__init__()
+        self.phone = phone
+        self.store = store
+        self.flush_delay = flush_delay
+        self.state_dirty = False
+        self.dirty_entities: Dict[int, EntityRow] = {}
+        # 实体ID -> 当前行，与 _entities 保持一致，同一ID只保留一行
+        self.entity_rows: Dict[int, EntityRow] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        state, entities = await self.store.load(self.phone)
+        if state is not None:
+            self._dc_id = state["dc_id"] or 0
+            self._server_address = state["server_address"]
+            self._port = state["port"]
+            self._auth_key = AuthKey(data=state["auth_key"]) if state["auth_key"] else None
+            self._takeout_id = state["takeout_id"]
+            for entity_id, (pts, qts, date, seq) in state["update_states"].items():
+                self._update_states[int(entity_id)] = updates.State(
+                    pts=pts, qts=qts, date=datetime.fromtimestamp(date, tz=timezone.utc), seq=seq, unread_count=0
+                )
+        self.entity_rows = dict(entities)
+        self._entities = set(entities.values())
+        LOG.info(f"Session loaded. Phone: {self.phone}, Authorized: {self._auth_key is not None}, "
+                 f"Entities: {len(self._entities)}")
+
+    def dump_state(self) -> dict:
+        return {
+            "dc_id": self._dc_id,
+            "server_address": self._server_address,
+            "port": self._port,
+            "auth_key": self._auth_key.key if self._auth_key else None,
+            "takeout_id": self._takeout_id,
+            "update_states": {
+                str(entity_id): [state.pts, state.qts, int(state.date.timestamp()), state.seq]
+                for entity_id, state in self._update_states.items()
+            },
+        }
+
+    def mark_state_dirty(self):
+        self.state_dirty = True
+        self.schedule_flush()
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self.mark_state_dirty()
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self.mark_state_dirty()
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self.mark_state_dirty()
+
+    def set_update_state(self, entity_id, state):
+        # 更新状态变化频繁，延迟写入时合并
+        super().set_update_state(entity_id, state)
+        self.mark_state_dirty()
+
+    def process_entities(self, tlo):
+        rows = {row[0]: row for row in self._entities_to_rows(tlo) if self.entity_rows.get(row[0]) != row}
+        if not rows:
+            return
+        for entity_id, row in rows.items():
+            # 覆盖同一ID的旧行，避免按ID查找时读到过期的 access_hash
+            if (old_row := self.entity_rows.get(entity_id)) is not None:
+                self._entities.discard(old_row)
+            self._entities.add(row)
+            self.entity_rows[entity_id] = row
+        self.dirty_entities.update(rows)
+        self.schedule_flush()
+
+    def save(self):
+        self.state_dirty = True
+        self.schedule_flush()
+
+    def close(self):
+        self.schedule_flush()
+
+    def delete(self):
+        self.state_dirty = False
+        self.dirty_entities.clear()
+        self.entity_rows.clear()
+        asyncio.get_running_loop().create_task(self.store.delete(self.phone))
+
+    def clone(self, to_instance=None):
+        # 其他数据中心的导出连接只需要内存会话
+        return super().clone(to_instance or MemorySession())
+
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = loop.create_task(self.flush_later())
+
+    async def flush_later(self):
+        # 写入期间的变更找到的是当前任务，不会另起任务，循环到没有待写入的变更
+        while self.state_dirty or self.dirty_entities:
+            await asyncio.sleep(self.flush_delay)
+            if not await self.flush():
+                # 写入失败时不在这里重试，下次变更或关闭时再写入
+                return
+
+    async def flush(self) -> bool:
+        """
+        写入待保存的授权信息和实体
+        :return: 是否写入成功
+        """
+        async with self.lock:
+            state = self.dump_state() if self.state_dirty else None
+            entities, self.dirty_entities = self.dirty_entities, {}
+            self.state_dirty = False
+            if state is None and not entities:
+                return True
+            try:
+                await self.store.save(self.phone, state, entities)
+            except Exception as e:
+                # 写入失败时保留变更，下次一起写入
+                LOG.exception(f"Session flush failed. Phone: {self.phone}, Error: {e}")
+                self.state_dirty = self.state_dirty or state is not None
+                self.dirty_entities = {**entities, **self.dirty_entities}
+                return False
+            return True
+
+    @classmethod
+    def read_session_file(cls, path: str) -> Tuple[Optional[dict], Dict[int, EntityRow]]:
+        """
+        读取 Telethon 的 sqlite session 文件，格式与 SessionStore.load 一致
+        :param path:
+        :return: 文件中没有授权信息时 state 为 None
+        """
+        file_session = SQLiteSession(path)
+        try:
+            if file_session.auth_key is None:
+                return None, {}
+            state = {
+                "dc_id": file_session.dc_id,
+                "server_address": file_session.server_address,
+                "port": file_session.port,
+                "auth_key": file_session.auth_key.key,
+                "takeout_id": file_session.takeout_id,
+                "update_states": {
+                    str(entity_id): [state.pts, state.qts, int(state.date.timestamp()), state.seq]
+                    for entity_id, state in file_session.get_update_states()
+                },
+            }
+            cursor = file_session._cursor()
+            try:
+                rows = cursor.execute("select id, hash, username, phone, name from entities").fetchall()
+            finally:
+                cursor.close()
+            return state, {row[0]: tuple(row) for row in rows}
+        finally:
+            file_session.close()
+
+
+SESSION_STORES: Dict[str, SessionStore] = {
+    "db": DBSessionStore(),
+    "redis": RedisSessionStore(),
+}
@@ -0,0 +1,5 @@
+import os
+
+# 测试使用示例配置，需在导入 cores.config 之前设置
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("CONFIG_FILE_PATH", os.path.join(ROOT_PATH, "config.ini.example"))
@@ -0,0 +1,28 @@
+from app.tg.models import Dialog
+from cores.constant.tg import DialogType
+
+
+def make_dialog(**kwargs):
+    fields = {"tg_id": 1, "title": "title", "username": "name", "type": DialogType.CHANNEL, "access_hash": 10}
+    return Dialog(**{**fields, **kwargs})
+
+
+def test_fingerprint_stable():
+    assert make_dialog().get_fingerprint() == make_dialog().get_fingerprint()
+
+
+def test_fingerprint_changes_with_synced_fields():
+    fingerprint = make_dialog().get_fingerprint()
+    assert make_dialog(title="other").get_fingerprint() != fingerprint
+    assert make_dialog(username=None).get_fingerprint() != fingerprint
+    assert make_dialog(type=DialogType.GROUP).get_fingerprint() != fingerprint
+    assert make_dialog(access_hash=11).get_fingerprint() != fingerprint
+
+
+def test_fingerprint_ignores_other_fields():
+    assert make_dialog(tg_id=2).get_fingerprint() == make_dialog().get_fingerprint()
+
+
+def test_fingerprint_fits_bigint():
+    fingerprint = make_dialog().get_fingerprint()
+    assert -2 ** 63 <= fingerprint < 2 ** 63
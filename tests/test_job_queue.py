@@ -0,0 +1,168 @@
+import asyncio
+import json
+
+import pytest
+
+from cores import job_queue
+from cores.job_queue import RedisJobQueue
+
+fakeredis = pytest.importorskip("fakeredis")
+# 作业状态使用 lua 脚本，fakeredis 需要 lupa 才支持 EVAL
+pytest.importorskip("lupa")
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(job_queue, "ASYNC_REDIS", client)
+    return client
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def make_queue(**kwargs) -> RedisJobQueue:
+    return RedisJobQueue("test:jobs", "test", **kwargs)
+
+
+async def get_state(redis, queue: RedisJobQueue, key: str):
+    state = await redis.get(queue.get_state_key(key))
+    return json.loads(state) if state else None
+
+
+def test_read_and_ack(redis):
+    async def main():
+        queue = make_queue()
+        job_id = await queue.put({"a": 1})
+        jobs = await queue.read("consumer", block=0)
+        assert [job.id for job in jobs] == [job_id]
+        assert jobs[0].data == {"a": 1} and jobs[0].deliveries == 1
+        # 同一消费组内不会重复读取
+        assert await queue.read("other", block=0) == []
+        await queue.ack(jobs[0])
+        assert (await redis.xpending(queue.stream, queue.group))["pending"] == 0
+
+    run(main())
+
+
+def test_fail_requeues_then_dead(redis):
+    async def main():
+        queue = make_queue(max_deliveries=2)
+        await queue.put({"a": 1})
+        job, = await queue.read("consumer", block=0)
+        await queue.fail(job, "error")
+        # 立即重新入队，投递次数累计
+        retry, = await queue.read("consumer", block=0)
+        assert retry.id != job.id and retry.data == job.data and retry.deliveries == 2
+        await queue.fail(retry, "error")
+        # 达到投递上限转入死信
+        assert await queue.read("consumer", block=0) == []
+        dead = await redis.xrange(queue.dead_stream)
+        assert len(dead) == 1 and dead[0][1]["error"] == "error"
+        assert (await redis.xpending(queue.stream, queue.group))["pending"] == 0
+
+    run(main())
+
+
+def test_reclaim_idle_job(redis):
+    async def main():
+        queue = make_queue(reclaim_idle=0.05)
+        await queue.put({"a": 1})
+        job, = await queue.read("dead-consumer", block=0)
+        await asyncio.sleep(0.1)
+        reclaimed, = await queue.read("consumer", block=0)
+        assert reclaimed.id == job.id and reclaimed.deliveries == 2
+
+    run(main())
+
+
+def test_touch_keeps_job_claimed(redis):
+    async def main():
+        queue = make_queue(reclaim_idle=0.1)
+        await queue.put({"a": 1})
+        job, = await queue.read("consumer", block=0)
+        for _ in range(3):
+            await asyncio.sleep(0.05)
+            await queue.touch(job, "consumer")
+            # 续期后不会被其他消费者认领
+            assert await queue.read("other", block=0) == []
+
+    run(main())
+
+
+def test_submit_single_flight(redis):
+    async def main():
+        queue = make_queue()
+        submitted, state = await queue.submit("phone", {"a": 1})
+        assert submitted and state["status"] == "queued" and state["job_id"]
+        again, current = await queue.submit("phone", {"a": 2})
+        assert not again and current["job_id"] == state["job_id"]
+        assert await redis.xlen(queue.stream) == 1
+        # 不同 key 互不影响
+        assert (await queue.submit("other", {}))[0]
+
+    run(main())
+
+
+def test_state_follows_job(redis):
+    async def main():
+        queue = make_queue(max_deliveries=2)
+        await queue.submit("phone", {})
+        job, = await queue.read("consumer", block=0)
+        assert job.data == {"key": "phone"}
+        await queue.set_state(job, "running")
+        assert (await get_state(redis, queue, "phone"))["status"] == "running"
+        await queue.fail(job, "error")
+        # 重试期间仍然单飞
+        state = await get_state(redis, queue, "phone")
+        assert state["status"] == "retrying" and state["job_id"] != job.id
+        assert not (await queue.submit("phone", {}))[0]
+        retry, = await queue.read("consumer", block=0)
+        await queue.ack(retry)
+        assert await get_state(redis, queue, "phone") is None
+        assert (await queue.submit("phone", {}))[0]
+
+    run(main())
+
+
+def test_dead_job_clears_state(redis):
+    async def main():
+        queue = make_queue(max_deliveries=1)
+        await queue.submit("phone", {})
+        job, = await queue.read("consumer", block=0)
+        await queue.fail(job, "error")
+        assert await get_state(redis, queue, "phone") is None
+
+    run(main())
+
+
+def test_ack_keeps_state_of_newer_job(redis):
+    async def main():
+        queue = make_queue()
+        await queue.submit("phone", {})
+        job, = await queue.read("consumer", block=0)
+        await redis.delete(queue.get_state_key("phone"))
+        _, state = await queue.submit("phone", {})
+        # 旧作业完成时不删除新作业的状态
+        await queue.ack(job)
+        assert (await get_state(redis, queue, "phone"))["job_id"] == state["job_id"]
+
+    run(main())
+
+
+def test_running_state_expires_with_heartbeat(redis):
+    async def main():
+        queue = make_queue(reclaim_idle=0.1)
+        await queue.submit("phone", {})
+        job, = await queue.read("consumer", block=0)
+        await queue.set_state(job, "running")
+        await asyncio.sleep(0.06)
+        await queue.touch(job, "consumer")
+        await asyncio.sleep(0.06)
+        assert (await get_state(redis, queue, "phone"))["status"] == "running"
+        # 消费者宕机后不再续期，状态在 reclaim_idle 内失效
+        await asyncio.sleep(0.15)
+        assert await get_state(redis, queue, "phone") is None
+
+    run(main())
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+from crontabs.dialog.message_sync import MessageBatcher
+
+
+def make_messages(*grouped_ids):
+    return [SimpleNamespace(id=index, grouped_id=grouped_id) for index, grouped_id in enumerate(grouped_ids, 1)]
+
+
+def ids(messages):
+    return [message.id for message in messages]
+
+
+def test_ready_when_batch_full():
+    batcher = MessageBatcher(batch_size=3, max_wait=60)
+    messages = make_messages(None, None, None)
+    assert not batcher.add(messages[0])
+    assert not batcher.add(messages[1])
+    assert batcher.add(messages[2])
+    assert ids(batcher.pop()) == [1, 2, 3]
+    assert not batcher.is_ready()
+
+
+def test_ready_after_max_wait():
+    batcher = MessageBatcher(batch_size=10, max_wait=0)
+    assert batcher.add(make_messages(None)[0])
+
+
+def test_batch_size_capped_to_forward_limit():
+    assert MessageBatcher(batch_size=1000).batch_size == 100
+    assert MessageBatcher(batch_size=0).batch_size == 1
+
+
+def test_trailing_album_held_until_complete():
+    batcher = MessageBatcher(batch_size=3, max_wait=60)
+    first, album_1, album_2, album_3 = make_messages(None, 7, 7, 7)
+    for message in (first, album_1, album_2):
+        batcher.add(message)
+    # 末尾的相册可能还不完整，留到下一批
+    assert ids(batcher.pop()) == [1]
+    batcher.add(album_3)
+    assert ids(batcher.pop(complete=True)) == [2, 3, 4]
+
+
+def test_only_incomplete_album_returns_empty():
+    batcher = MessageBatcher(batch_size=2, max_wait=60)
+    for message in make_messages(5, 5):
+        batcher.add(message)
+    assert batcher.pop() == []
+    assert ids(batcher.messages) == [1, 2]
+
+
+def test_timed_flush_holds_trailing_album():
+    batcher = MessageBatcher(batch_size=10, max_wait=0)
+    for message in make_messages(None, 5):
+        batcher.add(message)
+    # 超时发送时末尾的相册也不强制发送
+    assert batcher.is_ready()
+    assert ids(batcher.pop()) == [1]
+    assert ids(batcher.messages) == [2]
+
+
+
+@pytest.mark.parametrize("complete", [True, False])
+def test_album_followed_by_other_message_is_not_split(complete):
+    batcher = MessageBatcher(batch_size=10, max_wait=60)
+    for message in make_messages(5, 5, None):
+        batcher.add(message)
+    assert ids(batcher.pop(complete=complete)) == [1, 2, 3]
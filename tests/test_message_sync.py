@@ -0,0 +1,200 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from tortoise import Tortoise
+
+from app.tg.models import Account, Dialog, DialogSync, DialogSyncMessage
+from cores.constant.tg import DialogSyncSetting
+from crontabs.dialog import message_sync
+from crontabs.dialog.message_sync import DialogMessageSync
+
+
+def run_with_db(func):
+    async def main():
+        await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["app.system.models", "app.tg.models"]})
+        await Tortoise.generate_schemas()
+        try:
+            return await func()
+        finally:
+            await Tortoise.close_connections()
+
+    return asyncio.run(main())
+
+
+async def create_task(last_message_id: int = 0) -> DialogSync:
+    account = await Account.create(name="account", phone="+8613800000000", tg_id=1)
+    from_dialog = await Dialog.create(account=account, tg_id=10, title="from")
+    to_dialog = await Dialog.create(account=account, tg_id=20, title="to")
+    return await DialogSync.create(account=account, from_dialog=from_dialog, to_dialog=to_dialog,
+                                   last_message_id=last_message_id)
+
+
+def make_messages(*message_ids):
+    return [SimpleNamespace(id=message_id, grouped_id=None, message=f"text {message_id}", photo=None, document=None)
+            for message_id in message_ids]
+
+
+class FakeClient:
+    """按 min_id 正序返回历史消息"""
+
+    def __init__(self, message_ids):
+        self.messages = make_messages(*message_ids)
+        self.min_ids = []
+
+    async def get_messages(self, entity, limit, min_id, reverse):
+        self.min_ids.append(min_id)
+        return [message for message in self.messages if message.id > min_id][:limit]
+
+
+@pytest.fixture
+def lease(monkeypatch):
+    async def check(account_id):
+        pass
+
+    monkeypatch.setattr(message_sync.TG_ACCOUNT_LEASES, "check", check)
+
+
+async def get_watermark(task: DialogSync) -> int:
+    return (await DialogSync.get(id=task.id)).last_message_id
+
+
+def test_watermark_never_goes_backwards():
+    async def main():
+        task = await create_task()
+        await DialogMessageSync.save_watermark(task, 10)
+        assert await get_watermark(task) == 10
+        # 较小的水位不会覆盖已保存的水位，包括其他进程持有的过期对象
+        stale = await DialogSync.get(id=task.id)
+        stale.last_message_id = 0
+        await DialogMessageSync.save_watermark(stale, 5)
+        assert await get_watermark(task) == 10
+        assert stale.last_message_id == 5
+        await DialogMessageSync.save_watermark(task, 10)
+        await DialogMessageSync.save_watermark(task, 12)
+        assert await get_watermark(task) == 12 and task.last_message_id == 12
+
+    run_with_db(main)
+
+
+def test_save_delivered_writes_map_and_watermark(lease):
+    async def main():
+        task = await create_task()
+        messages = make_messages(1, 2, 3)
+        # 发送失败的消息不写映射，水位推进到整批的最后一条
+        await DialogMessageSync.save_delivered(task, messages, [SimpleNamespace(id=101), None, SimpleNamespace(id=103)])
+        mappings = await DialogSyncMessage.filter(sync_id=task.id).order_by("source_message_id")
+        assert [(m.source_message_id, m.target_message_id) for m in mappings] == [(1, 101), (3, 103)]
+        assert await get_watermark(task) == 3
+
+    run_with_db(main)
+
+
+def test_save_delivered_rolls_back_map_with_watermark(lease, monkeypatch):
+    async def main():
+        task = await create_task(last_message_id=5)
+        save_watermark = DialogMessageSync.save_watermark.__func__
+
+        async def failing_save_watermark(cls, *args):
+            await save_watermark(cls, *args)
+            raise RuntimeError("crash")
+
+        monkeypatch.setattr(DialogMessageSync, "save_watermark", classmethod(failing_save_watermark))
+        with pytest.raises(RuntimeError):
+            await DialogMessageSync.save_delivered(task, make_messages(6), [SimpleNamespace(id=106)])
+        # 映射和水位在同一个事务中，失败时都不写入
+        assert await DialogSyncMessage.filter(sync_id=task.id).count() == 0
+        assert await get_watermark(task) == 5
+
+    run_with_db(main)
+
+
+def test_restart_resumes_after_watermark(lease):
+    async def main():
+        task = await create_task()
+        script = DialogMessageSync()
+        client = FakeClient(range(1, 251))
+        pages = script.iter_history_pages(client, task.account, None, task.last_message_id)
+        first_page = await pages.__anext__()
+        await DialogMessageSync.save_delivered(task, first_page, first_page)
+        await pages.aclose()
+
+        # 重启后从数据库读取水位，只获取水位之后的消息
+        restarted = DialogMessageSync()
+        task = await DialogSync.get(id=task.id).select_related("account")
+        client.min_ids.clear()
+        message_ids = [message.id async for page in restarted.iter_history_pages(
+            client, task.account, None, task.last_message_id
+        ) for message in page]
+        assert client.min_ids[0] == 100
+        assert message_ids == list(range(101, 251))
+
+    run_with_db(main)
+
+
+def test_failed_target_does_not_stop_other_targets(monkeypatch):
+    async def main():
+        script = DialogMessageSync()
+        client = FakeClient(range(1, 251))
+        ok, broken = SimpleNamespace(id=1, last_message_id=0), SimpleNamespace(id=2, last_message_id=0)
+        delivered = []
+
+        async def deliver_batch(client, task, from_peer, to_peer, messages, settings):
+            if task is broken:
+                raise RuntimeError("chat write forbidden")
+            delivered.extend(message.id for message in messages)
+            task.last_message_id = messages[-1].id
+
+        monkeypatch.setattr(script, "deliver_batch", deliver_batch)
+        monkeypatch.setattr(message_sync.config_settings.tg, "pipeline_queue_depth", 1)
+        settings = DialogSyncSetting(batch_size=10)
+        failures = await script.sync_history(client, SimpleNamespace(id=1), None,
+                                             [(ok, settings, None), (broken, settings, None)])
+        # 失败的目标单独上报，其他目标完整投递
+        assert list(failures) == [2]
+        assert delivered == list(range(1, 251)) and ok.last_message_id == 250
+
+    asyncio.run(main())
+
+
+def test_fetch_failure_cancels_all_stages(monkeypatch):
+    async def main():
+        script = DialogMessageSync()
+
+        async def iter_history_pages(client, account, entity, min_id):
+            yield make_messages(1, 2)
+            raise RuntimeError("fetch failed")
+
+        async def deliver_batch(client, task, from_peer, to_peer, messages, settings):
+            task.last_message_id = messages[-1].id
+
+        monkeypatch.setattr(script, "iter_history_pages", iter_history_pages)
+        monkeypatch.setattr(script, "deliver_batch", deliver_batch)
+        task = SimpleNamespace(id=1, last_message_id=0)
+        with pytest.raises(RuntimeError, match="fetch failed"):
+            await script.sync_history(None, SimpleNamespace(id=1), None, [(task, DialogSyncSetting(), None)])
+
+    asyncio.run(main())
+
+
+def test_changes_routed_to_history_and_live_syncs(monkeypatch):
+    async def main():
+        script = DialogMessageSync()
+        started = []
+
+        async def start_live(account):
+            started.append(account.id)
+
+        monkeypatch.setattr(script, "start_live", start_live)
+        monkeypatch.setattr(message_sync.TG_ACCOUNT_LEASES, "owned", {1})
+        account = SimpleNamespace(id=1)
+        history = SimpleNamespace(id=1, account_id=1, account=account, from_dialog=SimpleNamespace(tg_id=-1001))
+        live = SimpleNamespace(id=2, account_id=1, account=account, from_dialog=SimpleNamespace(tg_id=-1001))
+        await script.update_live_routes([(history, DialogSyncSetting()),
+                                         (live, DialogSyncSetting(only_latest_message=True))])
+        assert started == [1]
+        # 新消息只投递给实时同步任务，编辑和删除同步到全部任务
+        assert [task.id for task, _ in script.live_routes[1][-1001]] == [2]
+        assert [task.id for task, _ in script.get_change_routes(1, -1001)] == [1, 2]
+
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from cores.config import settings
+from cores.constant.socket import SioEvent
+from crontabs import base
+from crontabs.base import SIOClientMethod
+
+EVENT = SioEvent.TG_ACCOUNT_DIALOG_INFO_SYNC_PROGRESS
+
+
+@pytest.fixture
+def emitted(monkeypatch):
+    messages = []
+
+    async def emit(event, data=None, room=None):
+        messages.append((room, data))
+
+    monkeypatch.setattr(base.sio, "emit", emit)
+    return messages
+
+
+def test_reporters_in_same_room_share_throttle(emitted):
+    async def main():
+        async with SIOClientMethod.progress(EVENT, "room") as fetch, \
+                SIOClientMethod.progress(EVENT, "room") as save:
+            assert len(SIOClientMethod.progress_coalescers) == 1
+            for _ in range(30):
+                fetch.update()
+                save.update()
+                await asyncio.sleep(0.01)
+        # 约 0.3 秒内按房间限流，两个上报合计不超过 1 + 0.3 * 每秒次数，加上两个最终状态
+        running = [data for _, data in emitted if data["status"] == "running"]
+        assert 1 <= len(running) <= 1 + int(0.4 * settings.tg.progress_emits_per_second)
+        assert [data["status"] for _, data in emitted[-2:]] == ["success", "success"]
+
+    asyncio.run(main())
+    assert SIOClientMethod.progress_coalescers == {}
+
+
+def test_rooms_are_throttled_separately(emitted):
+    async def main():
+        async with SIOClientMethod.progress(EVENT, "a") as a, SIOClientMethod.progress(EVENT, "b") as b:
+            a.update()
+            b.update()
+            await asyncio.sleep(0.01)
+        assert {room for room, data in emitted if data["status"] == "running"} == {"a", "b"}
+
+    asyncio.run(main())
+
+
+def test_final_status_drops_own_pending_update(emitted):
+    async def main():
+        async with SIOClientMethod.progress(EVENT, "room", stage="fetch") as progress:
+            progress.update()
+            progress.update(total=10)
+        await asyncio.sleep(0.01)
+        # 未发送的更新被最终状态取代
+        assert [data["status"] for _, data in emitted] == ["success"]
+        assert emitted[0][1]["done"] == 2 and emitted[0][1]["total"] == 10
+
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from telethon import errors
+
+from cores.constant.tg import TGRequestType
+from crontabs.rate_limiter import AdaptiveTokenBucket, TGRateLimiter
+
+
+def test_flood_wait_halves_rate_down_to_minimum():
+    bucket = AdaptiveTokenBucket(max_rate=16, min_rate_ratio=1 / 4)
+    bucket.on_flood_wait(0)
+    assert bucket.rate == 8
+    bucket.on_flood_wait(0)
+    bucket.on_flood_wait(0)
+    assert bucket.rate == 4
+
+
+def test_success_recovers_rate_up_to_maximum():
+    bucket = AdaptiveTokenBucket(max_rate=10, increase_ratio=1 / 10)
+    bucket.on_flood_wait(0)
+    bucket.on_success()
+    assert bucket.rate == 6
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 10
+
+
+def test_flood_wait_blocks_bucket():
+    bucket = AdaptiveTokenBucket(max_rate=10)
+    bucket.on_flood_wait(30)
+    assert 29 < bucket.blocked_for <= 30
+    assert bucket.tokens == 0
+
+
+def test_acquire_paces_requests():
+    async def run():
+        bucket = AdaptiveTokenBucket(max_rate=20)
+        started_at = time.monotonic()
+        # 初始只有 1 个令牌，之后每 0.05 秒 1 个
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - started_at
+
+    assert 0.15 <= asyncio.run(run()) < 0.5
+
+
+def test_acquire_waits_for_flood_wait():
+    async def run():
+        bucket = AdaptiveTokenBucket(max_rate=100)
+        bucket.on_flood_wait(0.2)
+        started_at = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started_at
+
+    assert asyncio.run(run()) >= 0.2
+
+
+def test_iterate_resumes_after_flood_wait():
+    calls = []
+
+    async def iter_items(offset_id=0, limit=None):
+        calls.append(offset_id)
+        for item in range(offset_id + 1, 8):
+            # 第一次迭代到第 5 项时被限流
+            if len(calls) == 1 and item == 5:
+                raise errors.FloodWaitError(request=None, capture=0)
+            yield item
+
+    async def run():
+        limiter = TGRateLimiter()
+        limiter.buckets[(1, TGRequestType.GET_DIALOGS)] = AdaptiveTokenBucket(max_rate=1000)
+        # 调用方传入的 offset_id 与 resume 返回的参数同名
+        return [item async for item in limiter.iterate(
+            1, TGRequestType.GET_DIALOGS, iter_items, resume=lambda item: {"offset_id": item}, key=lambda item: item,
+            page_size=2, offset_id=0,
+        )]
+
+    assert asyncio.run(run()) == [1, 2, 3, 4, 5, 6, 7]
+    assert calls == [0, 4]
@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+from telethon.tl.types import Channel, ChatPhotoEmpty, Message, PeerChannel, User
+
+from crontabs.rpc import decode_tl, encode_tl
+
+
+def test_encode_decode_user():
+    user = User(id=123, access_hash=-456, first_name="名字", username="name", bot=True,
+                bot_info_version=1)
+    decoded = decode_tl(encode_tl(user))
+    assert isinstance(decoded, User)
+    assert (decoded.id, decoded.access_hash, decoded.first_name, decoded.username, decoded.bot) == \
+        (123, -456, "名字", "name", True)
+    assert bytes(decoded) == bytes(user)
+
+
+def test_encode_decode_channel():
+    channel = Channel(id=1, title="channel", photo=ChatPhotoEmpty(), date=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                      access_hash=2, megagroup=True)
+    decoded = decode_tl(encode_tl(channel))
+    assert isinstance(decoded, Channel)
+    assert (decoded.title, decoded.access_hash, decoded.megagroup, decoded.date) == \
+        ("channel", 2, True, channel.date)
+    assert bytes(decoded) == bytes(channel)
+
+
+def test_encode_decode_message():
+    message = Message(id=10, peer_id=PeerChannel(1), date=datetime(2024, 1, 1, tzinfo=timezone.utc), message="hi",
+                      grouped_id=99)
+    decoded = decode_tl(encode_tl(message))
+    assert decoded.id == 10
+    assert decoded.message == "hi"
+    assert decoded.grouped_id == 99
+    assert decoded.peer_id == PeerChannel(1)
@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import pytest
+
+from crontabs.scheduler import CronTrigger, IntervalTrigger, Trigger
+
+
+def next_fire(expression: str, now: datetime) -> datetime:
+    return datetime.fromtimestamp(CronTrigger(expression).get_next(now.timestamp()))
+
+
+def test_cron_every_minute_is_strictly_after_now():
+    assert next_fire("* * * * *", datetime(2024, 1, 1, 10, 0, 30)) == datetime(2024, 1, 1, 10, 1)
+    assert next_fire("* * * * *", datetime(2024, 1, 1, 10, 1)) == datetime(2024, 1, 1, 10, 2)
+
+
+def test_cron_step_and_range():
+    assert next_fire("*/15 * * * *", datetime(2024, 1, 1, 10, 16)) == datetime(2024, 1, 1, 10, 30)
+    assert next_fire("0 9-17/4 * * *", datetime(2024, 1, 1, 14, 0)) == datetime(2024, 1, 1, 17, 0)
+    assert next_fire("0 9-17/4 * * *", datetime(2024, 1, 1, 17, 0)) == datetime(2024, 1, 2, 9, 0)
+
+
+def test_cron_rolls_over_month_and_year():
+    assert next_fire("0 0 1 * *", datetime(2024, 1, 31, 23, 59)) == datetime(2024, 2, 1)
+    assert next_fire("30 6 * 3 *", datetime(2024, 12, 31, 0, 0)) == datetime(2025, 3, 1, 6, 30)
+
+
+def test_cron_skips_missing_days():
+    assert next_fire("0 0 31 * *", datetime(2024, 4, 1)) == datetime(2024, 5, 31)
+    assert next_fire("0 0 29 2 *", datetime(2024, 3, 1)) == datetime(2028, 2, 29)
+
+
+def test_cron_weekday_sunday_is_0_or_7():
+    # 2024-01-07 为周日
+    assert next_fire("0 8 * * 0", datetime(2024, 1, 2)) == datetime(2024, 1, 7, 8)
+    assert next_fire("0 8 * * 7", datetime(2024, 1, 2)) == datetime(2024, 1, 7, 8)
+
+
+def test_cron_day_and_weekday_match_either():
+    # 日和周同时指定时满足任一即触发：15 号或周一，2024-01-08 为周一
+    assert next_fire("0 0 15 * 1", datetime(2024, 1, 2)) == datetime(2024, 1, 8)
+    assert next_fire("0 0 15 * 1", datetime(2024, 1, 9)) == datetime(2024, 1, 15)
+    # 只指定其中一个时另一个不参与匹配
+    assert next_fire("0 0 * * 1", datetime(2024, 1, 9)) == datetime(2024, 1, 15)
+    assert next_fire("0 0 10 * *", datetime(2024, 1, 9)) == datetime(2024, 1, 10)
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * * 8", "5-1 * * * *"])
+def test_cron_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        CronTrigger(expression)
+
+
+def test_interval_aligned_to_anchor():
+    trigger = IntervalTrigger(10)
+    trigger.anchor = 1000.0
+    assert trigger.get_next(1000.0) == 1010.0
+    assert trigger.get_next(1009.9) == 1010.0
+    # 错过的多次触发合并为一次
+    assert trigger.get_next(1055.0) == 1060.0
+
+
+def test_interval_must_be_positive():
+    with pytest.raises(AssertionError):
+        IntervalTrigger(0)
+
+
+def test_trigger_requires_get_next():
+    class NoNextTrigger(Trigger):
+        pass
+
+    with pytest.raises(TypeError):
+        NoNextTrigger()